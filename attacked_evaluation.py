@@ -1,3 +1,7 @@
+import hashlib
+import json
+import os
+import numpy as np
 import torchattacks
 import torch
 from params import (
@@ -6,6 +10,106 @@ from params import (
 )
 
 
+def file_hash(path):
+
+    hash = hashlib.sha1()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hash.update(chunk)
+
+    return hash.hexdigest()
+
+
+def attack_parameters(attack):
+    return {
+        key: val for key, val in sorted(vars(attack).items())
+        if isinstance(val, (int, float, str, bool)) and key not in ["device"]
+    }
+
+
+class AttackCache:
+    def __init__(self, path, key, size) -> None:
+
+        # entries are addressed by the hash of everything that defines the adversarial images
+        self.path = path + "/" + hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:20]
+        self.size = size
+        self.images = None
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+            with open(self.path + "/key.json", "w") as f:
+                json.dump(key, f)
+
+        if os.path.exists(self.path + "/images.npy"):
+            self.images = np.load(self.path + "/images.npy", mmap_mode="r+")
+            self.done = np.load(self.path + "/done.npy", mmap_mode="r+")
+
+    def create(self, shape):
+        self.images = np.lib.format.open_memmap(
+            self.path + "/images.npy", mode="w+", dtype=np.float16, shape=(self.size, *shape),
+        )
+        self.done = np.lib.format.open_memmap(
+            self.path + "/done.npy", mode="w+", dtype=np.uint8, shape=(self.size,),
+        )
+
+    def get(self, start, end):
+
+        if self.images is None or not self.done[start:end].all():
+            return None
+
+        return torch.from_numpy(np.array(self.images[start:end])).float()
+
+    def put(self, start, images):
+
+        if self.images is None:
+            self.create(images.shape[1:])
+
+        end = start + images.shape[0]
+        self.images[start:end] = images.detach().cpu().half().numpy()
+        self.images.flush()
+        self.done[start:end] = 1
+        self.done.flush()
+
+        return self.get(start, end)
+
+
+class CachedAttack:
+    def __init__(self, attack, cache: AttackCache) -> None:
+        self.attack = attack
+        self.cache = cache
+        self.position = 0
+
+    def __call__(self, input, target):
+
+        # batches arrive in dataset order, so the position gives the sample indices
+        start = self.position
+        end = start + input.shape[0]
+        self.position = end
+
+        result = self.cache.get(start, end)
+
+        if result is None:
+            result = self.cache.put(start, self.attack(input, target))
+
+        return result.to(input.device)
+
+
+def create_attack_cache(path, checkpoint_hash, attack, dataset_name, split, size, **parameters):
+
+    key = {
+        "checkpoint": checkpoint_hash,
+        "attack": type(attack).__name__,
+        "parameters": {**attack_parameters(attack), **parameters},
+        "dataset": dataset_name,
+        "split": split,
+        "size": size,
+    }
+
+    return AttackCache(path, key, size)
+
+
 def evaluate_attacked(attack_types, model, evaluate, dataset_name, **kwargs):
 
     torch.manual_seed(SEED)
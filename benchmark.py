@@ -0,0 +1,213 @@
+import time
+import fire
+import torch
+
+from main import process_activation_kwargs
+from modeling import create_ensemble_model_kwargs, create_layer_ensemble_model_kwargs
+from params import create_network
+from stacked_trials import StackedTrials, create_trial_network
+
+
+def time_forward(net, x, repeats, **forward_kwargs):
+
+    with torch.no_grad():
+        net(x, **forward_kwargs)
+
+        t = time.time()
+
+        for _ in range(repeats):
+            output = net(x, **forward_kwargs)
+
+        t = (time.time() - t) / repeats
+
+    return output, t
+
+
+def create_benchmark_network(network_name, kwargs, **overrides):
+
+    model_kwargs = {
+        key: val for key, val in kwargs.items()
+        if key not in ["network_type", "model_suffix", "epochs", "batch", "samples", "optimizer", "optimizer_lr"]
+    }
+    model_kwargs = process_activation_kwargs({**model_kwargs, **overrides})
+
+    return create_network(network_name, kwargs["network_type"])(**model_kwargs)
+
+
+def fused_prior(network_name="mnist_mini_base", batch=5, samples=10, repeats=20, device="cpu"):
+
+    input_shape = (1, 28, 28) if "mnist" in network_name else (3, 32, 32)
+    x = torch.randn(batch, *input_shape, device=device)
+
+    all_kwargs = [
+        (kwargs, {}) for kwargs in create_ensemble_model_kwargs(1)
+    ] + [
+        (kwargs, {"samples": samples}) for kwargs in create_layer_ensemble_model_kwargs(1)
+    ]
+
+    for kwargs, forward_kwargs in all_kwargs:
+
+        if kwargs["prior_scale"] <= 0:
+            continue
+
+        torch.manual_seed(0)
+        net = create_benchmark_network(network_name, kwargs).to(device)
+        net.eval()
+
+        if "samples" in forward_kwargs:
+            net.plan_seed = 0
+
+        output, t = time_forward(net, x, repeats, **forward_kwargs)
+
+        net.fused_prior = True
+        fused_output, fused_t = time_forward(net, x, repeats, **forward_kwargs)
+
+        if isinstance(output, list):
+            output = torch.stack(output)
+            fused_output = torch.stack(fused_output)
+
+        print(
+            kwargs["network_type"]
+            + " " + kwargs["model_suffix"]
+            + " separate=" + str(round(t * 1000, 3)) + "ms"
+            + " fused=" + str(round(fused_t * 1000, 3)) + "ms"
+            + " speedup=" + str(round(t / fused_t, 2))
+            + " max_diff=" + str(float((output - fused_output).abs().max()))
+        )
+
+
+def vectorized_ensemble(network_name="mnist_mini_base", batch=5, repeats=20, device="cpu", threads=None):
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    input_shape = (1, 28, 28) if "mnist" in network_name else (3, 32, 32)
+    x = torch.randn(batch, *input_shape, device=device)
+
+    for kwargs in create_ensemble_model_kwargs(1):
+
+        torch.manual_seed(0)
+        net = create_benchmark_network(network_name, kwargs).to(device)
+        net.eval()
+
+        output, t = time_forward(net, x, repeats)
+
+        net.vectorized = True
+        vectorized_output, vectorized_t = time_forward(net, x, repeats)
+
+        print(
+            kwargs["network_type"]
+            + " " + kwargs["model_suffix"]
+            + " threads=" + str(torch.get_num_threads())
+            + " loop=" + str(round(t * 1000, 3)) + "ms"
+            + " vectorized=" + str(round(vectorized_t * 1000, 3)) + "ms"
+            + " speedup=" + str(round(t / vectorized_t, 2))
+            + " max_diff=" + str(float((output - vectorized_output).abs().max()))
+        )
+
+
+def precision(network_name="resnet_18", network_type="classic", batch=32, repeats=5, device="cpu", channels_last=True):
+
+    input_shape = (1, 28, 28) if "mnist" in network_name else (3, 32, 32)
+    x = torch.randn(batch, *input_shape, device=device)
+
+    torch.manual_seed(0)
+    model_kwargs = {} if network_name.startswith(("resnet", "vgg", "densenet")) else {"activation": torch.nn.ReLU()}
+    net = create_network(network_name, network_type)(**model_kwargs).to(device)
+    net.eval()
+
+    output, t = time_forward(net, x, repeats)
+
+    net.set_precision("bf16", channels_last)
+    x = net.prepare_input(x)
+
+    with net.autocast(x):
+        reduced_output, reduced_t = time_forward(net, x, repeats)
+
+    print(
+        network_name
+        + " " + network_type
+        + " fp32=" + str(round(t * 1000, 3)) + "ms"
+        + " bf16=" + str(round(reduced_t * 1000, 3)) + "ms"
+        + " channels_last=" + str(channels_last)
+        + " speedup=" + str(round(t / reduced_t, 2))
+        + " max_diff=" + str(float((output - reduced_output.float()).abs().max()))
+        + " argmax_agreement=" + str(float((output.argmax(-1) == reduced_output.argmax(-1)).float().mean()))
+    )
+
+
+def fused_variational(network_name="mnist_mini_base", batch=64, repeats=20, device="cpu", use_batch_norm=False):
+
+    input_shape = (1, 28, 28) if "mnist" in network_name else (3, 32, 32)
+    x = torch.randn(batch, *input_shape, device=device)
+
+    torch.manual_seed(0)
+    net = create_network(network_name, "vnn")(activation=torch.nn.ReLU(), use_batch_norm=use_batch_norm).to(device)
+    fused_net = create_network(network_name, "vnn_fused")(activation=torch.nn.ReLU(), use_batch_norm=use_batch_norm).to(device)
+    fused_net.load_state_dict(net.state_dict())
+
+    net.eval()
+    fused_net.eval()
+
+    torch.manual_seed(1)
+    output, t = time_forward(net, x, repeats)
+    torch.manual_seed(1)
+    fused_output, fused_t = time_forward(fused_net, x, repeats)
+
+    print(
+        network_name
+        + " separate=" + str(round(t * 1000, 3)) + "ms"
+        + " fused=" + str(round(fused_t * 1000, 3)) + "ms"
+        + " speedup=" + str(round(t / fused_t, 2))
+        + " max_diff=" + str(float((output - fused_output).abs().max()))
+    )
+
+
+def stacked_trials(network_name="mnist_mlp", network_type="classic", trials=16, batch=16, repeats=20, device="cpu"):
+
+    input_shape = (1, 28, 28) if "mnist" in network_name else (3, 32, 32)
+    x = torch.randn(batch, *input_shape, device=device)
+    y = torch.randint(0, 10, (batch,), device=device)
+
+    nets = [
+        create_trial_network(
+            network_name, network_type, "Adam", "cross_entropy", batch, i,
+            {"activation": "relu", "optimizer_lr": 1e-4 * (i + 1)},
+        ).to(device)
+        for i in range(trials)
+    ]
+
+    def loop_step():
+        for net in nets:
+            net.train_step(x, y, sync_loss=False)
+
+    stacked = StackedTrials(nets)
+
+    def stacked_step():
+        stacked.train_step(x, y)
+
+    results = []
+
+    for step in [loop_step, stacked_step]:
+        step()
+
+        t = time.time()
+
+        for _ in range(repeats):
+            step()
+
+        results.append((time.time() - t) / repeats)
+
+    print(
+        network_name
+        + " " + network_type
+        + " trials=" + str(trials)
+        + " loop=" + str(round(results[0] * 1000, 3)) + "ms"
+        + " stacked=" + str(round(results[1] * 1000, 3)) + "ms"
+        + " speedup=" + str(round(results[0] / results[1], 2))
+    )
+
+
+if __name__ == "__main__":
+
+    fire.Fire()
@@ -0,0 +1,325 @@
+import itertools
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import torch
+from torchvision import transforms
+
+DEFAULT_SPLIT_SEED = 0
+
+
+def cached_normalization(transform):
+
+    # only ToTensor followed by optional Normalize can be stored as uint8 pixels
+    # and reproduced per batch, anything else falls back to the torchvision dataset
+    if isinstance(transform, transforms.Compose):
+        all_transforms = transform.transforms
+    else:
+        all_transforms = [transform]
+
+    if len(all_transforms) < 1 or not isinstance(all_transforms[0], transforms.ToTensor):
+        return None
+
+    mean, std = None, None
+
+    for current in all_transforms[1:]:
+        if isinstance(current, transforms.Normalize) and mean is None:
+            mean, std = current.mean, current.std
+        else:
+            return None
+
+    return mean, std
+
+
+def acquire_cache_lock(lock_path, cache_path, poll_seconds=1):
+
+    # the lock file is created exclusively, so only one process builds a cache and the others
+    # wait until it is published or the builder gives up and removes the lock
+    waiting = False
+
+    while not os.path.exists(cache_path):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            if not waiting:
+                print("Waiting for " + lock_path + ", remove it if no other process builds the cache")
+                waiting = True
+
+            time.sleep(poll_seconds)
+
+    return False
+
+
+def write_cache(dataset, cache_path, order=None):
+
+    lock_path = cache_path + ".lock"
+
+    if not acquire_cache_lock(lock_path, cache_path):
+        return
+
+    try:
+        # another process finished the same cache while the lock was taken
+        if os.path.exists(cache_path):
+            return
+
+        if order is None:
+            order = np.arange(len(dataset))
+
+        first = np.asarray(dataset[0][0])
+        shape = first.shape if first.ndim == 3 else (*first.shape, 1)
+
+        # the files are written to a private directory that is published with a single rename
+        temp_path = tempfile.mkdtemp(dir=os.path.dirname(cache_path), prefix=os.path.basename(cache_path) + ".")
+
+        try:
+            images = np.lib.format.open_memmap(
+                temp_path + "/images.npy", mode="w+", dtype=np.uint8,
+                shape=(len(order), shape[2], shape[0], shape[1]),
+            )
+            targets = np.zeros(len(order), dtype=np.int64)
+
+            for i, index in enumerate(order):
+                image, target = dataset[int(index)]
+                image = np.asarray(image)
+                images[i] = image.reshape(shape).transpose(2, 0, 1)
+                targets[i] = target
+
+            images.flush()
+            del images
+
+            np.save(temp_path + "/targets.npy", targets)
+            np.save(temp_path + "/split.npy", order)
+
+            os.rename(temp_path, cache_path)
+        except BaseException:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+    finally:
+        os.remove(lock_path)
+
+
+class CachedDataset(torch.utils.data.Dataset):
+    def __init__(self, images, targets, mean=None, std=None, start=0, end=None) -> None:
+        super().__init__()
+
+        self.images = images
+        self.targets = targets
+        self.start = start
+        self.end = len(targets) if end is None else end
+        self.perturbation = None
+
+        if mean is None:
+            self.mean = None
+            self.std = None
+        else:
+            self.mean = torch.tensor(mean, dtype=torch.float32).reshape(1, -1, 1, 1)
+            self.std = torch.tensor(std, dtype=torch.float32).reshape(1, -1, 1, 1)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def normalize(self, images, indices):
+
+        images = images.float() / 255
+
+        if self.perturbation is not None:
+            images = self.perturbation(images, indices)
+
+        if self.mean is not None:
+            images = (images - self.mean) / self.std
+
+        return images
+
+    def slice(self, start, end):
+        return self.batch(slice(self.start + start, self.start + end))
+
+    def take(self, indices):
+        return self.batch(np.sort(indices) + self.start)
+
+    def batch(self, indices):
+        # the memmap is read only, so the batch is copied before it becomes a tensor
+        images = torch.from_numpy(np.array(self.images[indices]))
+        targets = torch.from_numpy(np.asarray(self.targets[indices]))
+
+        if isinstance(indices, slice):
+            indices = np.arange(indices.start, indices.stop)
+
+        return self.normalize(images, indices), targets
+
+    def __getitem__(self, index):
+
+        if index < 0:
+            index += len(self)
+
+        images, targets = self.slice(index, index + 1)
+
+        return images[0], int(targets[0])
+
+
+class CachedDataLoader:
+    def __init__(self, dataset: CachedDataset, batch_size=1, shuffle=False, rank=0, world_size=1, seed=0) -> None:
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shard_size(self):
+        return (len(self.dataset) + self.world_size - 1) // self.world_size
+
+    def __len__(self):
+        return (self.shard_size() + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+
+        start = self.start_batch * self.batch_size
+        self.start_batch = 0
+
+        if self.world_size > 1:
+            yield from self.iterate_shard(start)
+            return
+
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.dataset), generator=generator).numpy()
+
+        for i in range(start, len(self.dataset), self.batch_size):
+            if self.shuffle:
+                yield self.dataset.take(order[i:i + self.batch_size])
+            else:
+                yield self.dataset.slice(i, min(i + self.batch_size, len(self.dataset)))
+
+    def iterate_shard(self, start=0):
+
+        # same order on every rank, padded like DistributedSampler so all shards have equal length
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.dataset), generator=generator).numpy()
+        else:
+            order = np.arange(len(self.dataset))
+
+        padding = self.shard_size() * self.world_size - len(order)
+        order = np.concatenate([order, order[:padding]])[self.rank::self.world_size]
+
+        for i in range(start, len(order), self.batch_size):
+            yield self.dataset.take(order[i:i + self.batch_size])
+
+
+def create_cached_train_validation_test(params, transform_train, transform_test, split_seed=None):
+
+    # every split is cached on its own, a split with random augmentation is returned as None
+    train_normalization = cached_normalization(transform_train)
+    test_normalization = cached_normalization(transform_test)
+    train, val, test = None, None, None
+
+    if split_seed is None:
+        split_seed = DEFAULT_SPLIT_SEED
+
+    # the split seed is part of the cache name, so a cache always holds the split its name describes
+    cache_path = params["path"] + "cache/" + params["dataset"].__name__ + "/"
+    train_name = (
+        cache_path + "train_" + str(params["train_size"]) + "_" + str(params["validation_size"])
+        + "_seed" + str(split_seed)
+    )
+    test_name = cache_path + "test"
+
+    os.makedirs(cache_path, exist_ok=True)
+
+    if train_normalization is not None and not os.path.exists(train_name):
+        print("Caching " + train_name)
+        train_val = params["dataset"](params["path"], train=True, download=True)
+
+        generator = torch.Generator().manual_seed(split_seed)
+        order = torch.randperm(len(train_val), generator=generator).numpy()
+        write_cache(train_val, train_name, order[:params["train_size"] + params["validation_size"]])
+
+    if test_normalization is not None and not os.path.exists(test_name):
+        print("Caching " + test_name)
+        test = params["dataset"](params["path"], train=False, download=True)
+        write_cache(test, test_name)
+
+    if train_normalization is not None:
+        train_images = np.load(train_name + "/images.npy", mmap_mode="r")
+        train_targets = np.load(train_name + "/targets.npy")
+
+        train = CachedDataset(train_images, train_targets, *train_normalization, 0, params["train_size"])
+        val = CachedDataset(
+            train_images, train_targets, *train_normalization,
+            params["train_size"], params["train_size"] + params["validation_size"],
+        )
+
+    if test_normalization is not None:
+        test_images = np.load(test_name + "/images.npy", mmap_mode="r")
+        test_targets = np.load(test_name + "/targets.npy")
+
+        test = CachedDataset(test_images, test_targets, *test_normalization)
+
+    return train, val, test
+
+
+def create_data_loader(dataset, batch, shuffle, num_workers, rank=0, world_size=1, seed=0, persistent_workers=False):
+
+    if isinstance(dataset, CachedDataset):
+        return CachedDataLoader(dataset, batch, shuffle, rank, world_size, seed)
+
+    persistent_workers = persistent_workers and num_workers > 0
+
+    if world_size > 1:
+        sampler = torch.utils.data.DistributedSampler(  # type: ignore
+            dataset, world_size, rank, shuffle=shuffle, seed=seed
+        )
+
+        return torch.utils.data.DataLoader(  # type: ignore
+            dataset, batch, sampler=sampler, num_workers=num_workers, persistent_workers=persistent_workers
+        )
+
+    loader = torch.utils.data.DataLoader(  # type: ignore
+        dataset, batch, shuffle=shuffle, num_workers=num_workers, generator=torch.Generator().manual_seed(seed),
+        persistent_workers=persistent_workers,
+    )
+    loader.seed = seed
+
+    return loader
+
+
+def set_loader_seed(loader, seed):
+
+    # reused loaders take the seed of the current run, the epoch is applied by set_loader_epoch
+    if isinstance(loader, CachedDataLoader):
+        loader.seed = seed
+    elif isinstance(getattr(loader, "sampler", None), torch.utils.data.DistributedSampler):
+        loader.sampler.seed = seed
+    else:
+        loader.seed = seed
+
+
+def set_loader_epoch(loader, epoch):
+
+    # the data order of an epoch only depends on the loader seed and the epoch
+    if isinstance(loader, CachedDataLoader):
+        loader.set_epoch(epoch)
+    elif isinstance(getattr(loader, "sampler", None), torch.utils.data.DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+    elif loader.generator is not None:
+        loader.generator.manual_seed(loader.seed + epoch)
+
+
+def skip_batches(loader, count):
+
+    if count == 0:
+        return loader
+
+    if isinstance(loader, CachedDataLoader):
+        loader.start_batch = count
+        return loader
+
+    return itertools.islice(loader, count, None)
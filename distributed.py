@@ -0,0 +1,103 @@
+import time
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def destroy_process_group(drain_seconds=1.0):
+
+    # gloo workers free finished work after the caller was released, which can drop tensors created
+    # in python and needs the gil, while destroy_process_group holds the gil and joins the workers,
+    # so the workers get time to go idle before the group is destroyed
+    time.sleep(drain_seconds)
+    dist.destroy_process_group()
+
+
+def broadcast_module(module: torch.nn.Module):
+
+    # frozen priors and unused ensemble members never get gradients,
+    # so every rank has to start from the same values
+    with torch.no_grad():
+        for tensor in [*module.parameters(), *module.buffers()]:
+            dist.broadcast(tensor.data, 0)
+
+
+def all_reduce_gradients(module: torch.nn.Module):
+
+    # layer ensembles sample different members on different ranks, missing
+    # gradients take part as zeros so all ranks reduce the same flat buffer
+    parameters = [p for p in module.parameters() if p.requires_grad]
+
+    if len(parameters) == 0:
+        return
+
+    # one flag per parameter is reduced with the gradients, members that no rank
+    # sampled keep a None gradient, so the optimizer skips them like in a single process
+    has_gradient = torch.tensor(
+        [p.grad is not None for p in parameters], dtype=parameters[0].dtype, device=parameters[0].device
+    )
+    flat = torch.cat([
+        *[(p.grad if p.grad is not None else torch.zeros_like(p)).reshape(-1) for p in parameters],
+        has_gradient,
+    ])
+    dist.all_reduce(flat)
+
+    has_gradient = (flat[-len(parameters):] > 0).tolist()
+    flat = flat[:-len(parameters)] / get_world_size()
+
+    offset = 0
+
+    for p, reduced in zip(parameters, has_gradient):
+        size = p.numel()
+        gradient = flat[offset:offset + size].view_as(p)
+
+        if not reduced:
+            p.grad = None
+        elif p.grad is None:
+            p.grad = gradient.clone()
+        else:
+            p.grad.copy_(gradient)
+
+        offset += size
+
+
+def average_buffers(module: torch.nn.Module):
+
+    with torch.no_grad():
+        for buffer in module.buffers():
+            if buffer.is_floating_point():
+                dist.all_reduce(buffer)
+                buffer /= get_world_size()
+            else:
+                dist.broadcast(buffer, 0)
+
+
+def all_gather_values(value: float):
+
+    values = torch.zeros(get_world_size(), dtype=torch.float64)
+    values[get_rank()] = float(value)
+
+    if is_distributed():
+        dist.all_reduce(values)
+
+    return values.tolist()
@@ -1,24 +1,31 @@
 from perturbed_evaluation import (
+    create_sweep_levels,
+    evaluate_sweep,
+    perturbation_levels,
     evaluate_bar_occluded,
     evaluate_gaussian,
     evaluate_randomly_occluded,
     evaluate_randomly_swapped,
     evaluate_uniform,
 )
-from attacked_evaluation import evaluate_attacked
-from metrics import AverageMetric
+from attacked_evaluation import CachedAttack, create_attack_cache, evaluate_attacked, file_hash
+from metrics import AverageMetric, ExponentialMovingAverageMetric, WindowedAverageMetric
 from networks.variational import VariationalBase
 from typing import Optional
 from core import give, rename_dict
 import torch
-from networks.network import Network
+from networks.network import Network, SampledNetwork
+from networks.checkpoint import CheckpointWriter, get_rng_states, load_training_state, set_rng_states
 import os
+import datetime
 import fire  # type:ignore
 import json
 
 from params import (
+    SEED,
     create_network,
     dataset_params,
+    perturbed_dataset_params,
     loss_functions,
     loss_functions_that_use_network,
     loss_params,
@@ -29,9 +36,32 @@ from params import (
 )
 import time
 from tensorboardX import SummaryWriter
+from summary import BatchedSummaryWriter, NullSummaryWriter
+from sweep_runtime import SweepRuntime
+from dataset_cache import (
+    CachedDataset,
+    create_cached_train_validation_test,
+    create_data_loader,
+    set_loader_epoch,
+    set_loader_seed,
+    skip_batches,
+)
+from distributed import (
+    all_gather_values,
+    all_reduce_gradients,
+    average_buffers,
+    barrier,
+    broadcast_module,
+    destroy_process_group,
+    get_rank,
+    get_world_size,
+    is_main_process,
+)
+import torch.distributed as dist
+import torch.multiprocessing as mp
 
 
-def create_train_validation_test(params):
+def create_train_validation_test(params, cache=False, split_seed=None):
 
     transform_train = (
         params["transform"]["train"]
@@ -44,17 +74,29 @@ def create_train_validation_test(params):
         else params["transform"]["all"]
     )
 
-    train_val = params["dataset"](
-        params["path"], train=True, download=True, transform=transform_train,
-    )
+    train, val, test = None, None, None
 
-    test = params["dataset"](
-        params["path"], train=False, download=True, transform=transform_test,
-    )
+    if cache:
+        # splits that can not be cached are loaded from the torchvision dataset below
+        train, val, test = create_cached_train_validation_test(
+            params, transform_train, transform_test, split_seed
+        )
 
-    train, val = torch.utils.data.random_split(  # type: ignore
-        train_val, [params["train_size"], params["validation_size"]]
-    )
+    if train is None:
+        train_val = params["dataset"](
+            params["path"], train=True, download=True, transform=transform_train,
+        )
+
+        train, val = torch.utils.data.random_split(  # type: ignore
+            train_val,
+            [params["train_size"], params["validation_size"]],
+            generator=None if split_seed is None else torch.Generator().manual_seed(split_seed),
+        )
+
+    if test is None:
+        test = params["dataset"](
+            params["path"], train=False, download=True, transform=transform_test,
+        )
 
     return train, val, test
 
@@ -73,6 +115,52 @@ def correct_count(output, target):
     return labels.eq(target.data.view_as(labels)).sum()
 
 
+def check_precision(net: Network, val, device, correct_count, samples, batches, tolerance):
+
+    autocast_dtype = net.autocast_dtype
+    corrects = {"fp32": 0, "reduced": 0}
+    total = 0
+
+    net.eval()
+
+    for i, (data, target) in enumerate(val):
+
+        if i >= batches:
+            break
+
+        data = data.to(device)
+        target = target.to(device)
+
+        for name, dtype in [("fp32", None), ("reduced", autocast_dtype)]:
+            net.autocast_dtype = dtype
+            # stochastic networks draw the same noise in both runs
+            torch.manual_seed(SEED + i)
+            _, correct = net.eval_step(data, target, correct_count=correct_count, samples=samples)
+            corrects[name] += int(correct)
+
+        total += len(target)
+
+    net.autocast_dtype = autocast_dtype
+
+    difference = abs(corrects["fp32"] - corrects["reduced"]) / total
+
+    print(
+        "precision check fp32_acc="
+        + str(corrects["fp32"] / total)
+        + " reduced_acc="
+        + str(corrects["reduced"] / total)
+        + " difference="
+        + str(difference)
+    )
+
+    if difference > tolerance:
+        raise ValueError(
+            "Reduced precision accuracy differs from fp32 by " + str(difference) + " > " + str(tolerance)
+        )
+
+    return difference
+
+
 def run_evaluation(net: Network, val, device, correct_count, batch, samples, eval_step=None):
 
     if eval_step is None:
@@ -169,6 +257,18 @@ def evaluate(
     save=True,
     start_global_std: Optional[float] = None,
     end_global_std: Optional[float] = None,
+    streaming_eval: bool = False,
+    track_eval_variance: bool = False,
+    dataset_cache: bool = False,
+    batch_perturbation: bool = False,
+    perturbation_types=None,
+    sweep_levels_per_forward: Optional[int] = 8,
+    attack_cache: Optional[str] = None,
+    attack_samples: int = 1,
+    precision: str = "fp32",
+    channels_last: bool = False,
+    precision_check_batches: int = 0,
+    precision_tolerance: float = 0.01,
     **kwargs,
 ):
 
@@ -204,6 +304,18 @@ def evaluate(
         "loss_sigma_0",
         "start_global_std",
         "end_global_std",
+        "streaming_eval",
+        "track_eval_variance",
+        "dataset_cache",
+        "batch_perturbation",
+        "perturbation_types",
+        "sweep_levels_per_forward",
+        "attack_cache",
+        "attack_samples",
+        "precision",
+        "channels_last",
+        "precision_check_batches",
+        "precision_tolerance",
     ]
 
     given_parameters = {
@@ -281,6 +393,9 @@ def evaluate(
 
     net.load(model_path, device)
     net.to(device)
+    net.set_precision(precision, channels_last)
+    net.streaming_eval = streaming_eval
+    net.track_eval_variance = track_eval_variance
 
     result = None
     fps = None
@@ -288,12 +403,15 @@ def evaluate(
 
     if evaluation_type == "normal":
 
-        train, val, test = create_train_validation_test(dataset_params[dataset_name])
+        train, val, test = create_train_validation_test(dataset_params[dataset_name], dataset_cache)
 
         current_dataset = {"train": train, "validation": val, "test": test}[split]
-        current_dataset = torch.utils.data.DataLoader(  # type: ignore
-            current_dataset, batch, shuffle=False, num_workers=4
-        )
+        current_dataset = create_data_loader(current_dataset, batch, shuffle=False, num_workers=4)
+
+        if precision != "fp32" and precision_check_batches > 0:
+            check_precision(
+                net, current_dataset, device, correct_count, samples, precision_check_batches, precision_tolerance
+            )
 
         result, fps = run_evaluation(net, current_dataset, device, correct_count, batch, samples)
     elif evaluation_type in [
@@ -304,12 +422,19 @@ def evaluate(
         "randomly_swapped",
     ]:
 
-        def evaluate_current(current_dataset_params):
-            train, val, test = create_train_validation_test(current_dataset_params)
-            current_dataset = {"train": train, "validation": val, "test": test,}[split]
-            current_dataset = torch.utils.data.DataLoader(  # type: ignore
-                current_dataset, batch, shuffle=False, num_workers=0
+        def evaluate_current(current_dataset_params, perturbation=None):
+            train, val, test = create_train_validation_test(
+                current_dataset_params, dataset_cache or (perturbation is not None)
             )
+            current_dataset = {"train": train, "validation": val, "test": test,}[split]
+
+            if perturbation is not None:
+                if not isinstance(current_dataset, CachedDataset):
+                    raise ValueError("Batched perturbations need a cacheable '" + split + "' split")
+
+                current_dataset.perturbation = perturbation
+
+            current_dataset = create_data_loader(current_dataset, batch, shuffle=False, num_workers=0)
 
             return run_evaluation(net, current_dataset, device, correct_count, batch, samples)
 
@@ -319,7 +444,22 @@ def evaluate(
             "bar_occluded": evaluate_bar_occluded,
             "randomly_occluded": evaluate_randomly_occluded,
             "randomly_swapped": evaluate_randomly_swapped,
-        }[evaluation_type](evaluate_current, dataset_name, **kwargs,)
+        }[evaluation_type](evaluate_current, dataset_name, batched=batch_perturbation, **kwargs,)
+    elif evaluation_type == "perturbation_sweep":
+
+        if perturbation_types is None:
+            perturbation_types = list(perturbation_levels.keys())
+
+        train, val, test = create_train_validation_test(perturbed_dataset_params[dataset_name](None), True)
+        current_dataset = {"train": train, "validation": val, "test": test,}[split]
+
+        if not isinstance(current_dataset, CachedDataset):
+            raise ValueError("Perturbation sweep needs a cacheable '" + split + "' split")
+
+        result = evaluate_sweep(
+            net, current_dataset, device, batch, samples, create_sweep_levels(perturbation_types, **kwargs),
+            levels_per_forward=sweep_levels_per_forward,
+        )
     elif evaluation_type in [
         "attacked",
     ]:
@@ -337,23 +477,37 @@ def evaluate(
                 std = self.std.reshape(1, self.channels, 1, 1)
                 return (input - mean) / std
 
+        if attack_cache is not None:
+            if split != "test" and not dataset_cache:
+                # random_split is not seeded, so sample indices are only stable with the dataset cache
+                raise ValueError("attack_cache on the '" + split + "' split needs dataset_cache")
+
+            checkpoint_hash = file_hash(model_path + "/model.pth")
+
         def evaluate_current(current_dataset_params, attack):
-            train, val, test = create_train_validation_test(current_dataset_params)
+            train, val, test = create_train_validation_test(current_dataset_params, dataset_cache)
             current_dataset = {"train": train, "validation": val, "test": test,}[split]
-            current_dataset = torch.utils.data.DataLoader(  # type: ignore
-                current_dataset, batch, shuffle=False, num_workers=0
-            )
+
+            if attack_cache is not None:
+                attack = CachedAttack(
+                    attack,
+                    create_attack_cache(
+                        attack_cache, checkpoint_hash, attack, dataset_name, split, len(current_dataset),
+                        attack_samples=attack_samples,
+                    ),
+                )
+
+            current_dataset = create_data_loader(current_dataset, batch, shuffle=False, num_workers=0)
 
             if "mean" in current_dataset_params:
                 normalized_net = torch.nn.Sequential(
                     Normalize(
                         current_dataset_params["mean"], current_dataset_params["std"],
                     ),
-                    net,
-                    torch.nn.Softmax(-1),
+                    SampledNetwork(net, samples, torch.nn.Softmax(-1)),
                 ).to(device)
             else:
-                normalized_net = net
+                normalized_net = SampledNetwork(net, samples)
 
             def attack_step(
                 input, target, correct_count=None, samples=1,
@@ -361,35 +515,20 @@ def evaluate(
                 nonlocal normalized_net
                 nonlocal net
 
-                def sampled_net(net, normalized_net, input, samples):
-                    average_output = None
-                    average_loss = None
-
-                    for step in range(samples):
+                def sampled_net(input):
+                    with torch.no_grad():
                         output = normalized_net(input)
-                        loss = (
-                            (net.loss_func(output, target, net, net.batch) if net.loss_uses_network else net.loss_func(output, target)).item()
-                            if hasattr(net, "loss_func")
-                            else None
-                        )
 
-                        if average_output is None:
-                            average_output = output
-                        else:
-                            average_output += output
-                        if average_loss is None:
-                            average_loss = loss
-                        else:
-                            average_loss += loss
-
-                    average_output /= samples
-                    if average_loss is not None:
-                        average_loss /= samples
-                    
-                    return average_output, average_loss
+                    loss = (
+                        (net.loss_func(output, target, net, net.batch) if net.loss_uses_network else net.loss_func(output, target)).item()
+                        if hasattr(net, "loss_func")
+                        else None
+                    )
+
+                    return output, loss
 
                 adv_images = attack(input, target)
-                output, loss = sampled_net(net, normalized_net, adv_images, samples)
+                output, loss = sampled_net(adv_images)
                 loss_dict = {
                     "loss": loss,
                 }
@@ -401,7 +540,7 @@ def evaluate(
                         loss_dict,
                         [
                             correct_count(output, target),
-                            correct_count(sampled_net(net, normalized_net, input, samples)[0], target),
+                            correct_count(sampled_net(input)[0], target),
                         ],
                     )
 
@@ -416,7 +555,7 @@ def evaluate(
             )
 
         result = evaluate_attacked(
-            attack_types, net, evaluate_current, dataset_name, **kwargs,
+            attack_types, SampledNetwork(net, attack_samples), evaluate_current, dataset_name, **kwargs,
         )
     else:
         raise ValueError("evaluation_type '" + evaluation_type + "' is unknown")
@@ -432,7 +571,7 @@ def evaluate(
         with open(
             model_path + "/results/eval_" + evaluation_type + "_" + split + ".txt", "w",
         ) as f:
-            f.write(str(result) + "\n")
+            f.write((json.dumps(result) if isinstance(result, list) else str(result)) + "\n")
 
     return result
 
@@ -754,6 +893,110 @@ def process_loss_kwargs(loss_name, kwargs):
     return kwargs, current_loss_params
 
 
+def record_validation(
+    net: Network,
+    val_acc,
+    model_path,
+    writer,
+    epoch,
+    current_step,
+    is_epoch_end,
+    batch,
+    samples,
+    save_best,
+    create_current_model_description,
+):
+
+    if is_epoch_end:
+        text = "epoch " + str(epoch + 1) + ": "
+    else:
+        text = "step " + str(current_step) + ": "
+
+    text += str(val_acc)
+
+    writer.add_scalar(
+        "val_acc",
+        (val_acc[0] if isinstance(val_acc, tuple) else val_acc),
+        current_step,
+    )
+
+    with open(
+        model_path + "/results/validation_batch_" + str(batch) + "samples_" + str(samples) + ".txt",
+        "a",
+    ) as f:
+        f.write(text + "\n")
+
+    # the best result stays in memory after the first read, as a newer description
+    # may still be queued in the checkpoint writer
+    if net.best_result is None:
+        best_description = get_best_description(
+            model_path + "/best/description.json"
+        )
+
+        if best_description is not None:
+            net.best_result = best_description["result"]
+
+    is_should_save_best = False
+
+    if net.best_result is None:
+        is_should_save_best = True
+    else:
+        is_should_save_best = net.best_result * 1.001 < (
+            val_acc[0] if isinstance(val_acc, tuple) else val_acc
+        )
+
+    if is_should_save_best and save_best:
+        print(":::Saving Best:::")
+
+        net.best_result = val_acc[0] if isinstance(val_acc, tuple) else val_acc
+        net.save(model_path + "/best")
+
+        data = {
+            "epoch": epoch + 1,
+            "batch": batch,
+            "samples": samples,
+            "result": (
+                val_acc[0] if isinstance(val_acc, tuple) else val_acc
+            ),
+        }
+
+        def write_best_description(data=data):
+            with open(model_path + "/best/description.json", "w") as file:
+                json.dump(data, file)
+
+            create_current_model_description(model_path + "/best")
+
+        # the description is written only after the best model itself
+        net.after_save(write_best_description)
+
+        print(":::Saved Best:::")
+
+
+def create_model_directories(model_path):
+
+    if not os.path.exists(model_path):
+        os.mkdir(model_path)
+    if not os.path.exists(model_path + "/results"):
+        os.mkdir(model_path + "/results")
+    if not os.path.exists(model_path + "/best"):
+        os.mkdir(model_path + "/best")
+    if not os.path.exists(model_path + "/summary"):
+        os.mkdir(model_path + "/summary")
+
+
+def create_model_path(network_name, network_type, dataset_name, model_suffix="", all_models_path="./models"):
+
+    full_network_name = network_name
+
+    if dataset_name not in network_name:
+        full_network_name = dataset_name + "_" + full_network_name
+
+    full_network_name += "_" + network_type
+    full_network_name += "" if model_suffix == "" else "_" + model_suffix
+
+    return all_models_path + "/" + full_network_name, full_network_name
+
+
 def train(
     network_name,
     network_type,
@@ -775,37 +1018,55 @@ def train(
     monte_carlo_steps: int = 5,
     allow_retrain: bool = True,
     all_models_path = "./models",
+    streaming_eval: bool = False,
+    metric_window: int = 100,
+    summary_steps: int = 50,
+    log_steps: Optional[int] = None,
+    dataset_cache: bool = False,
+    replicated_samples: bool = False,
+    precision: str = "fp32",
+    channels_last: bool = False,
+    async_checkpoint: bool = False,
+    keep_checkpoints: int = 0,
+    resume: bool = False,
+    shared_runtime: bool = False,
+    stop_epoch: Optional[int] = None,
     **kwargs,
 ):
 
     if model_path is None:
-
-        full_network_name = network_name
-
-        if dataset_name not in network_name:
-            full_network_name = dataset_name + "_" + full_network_name
-
-        full_network_name += "_" + network_type
-        full_network_name += "" if model_suffix == "" else "_" + model_suffix
-
-        model_path = all_models_path + "/" + full_network_name
+        model_path, full_network_name = create_model_path(
+            network_name, network_type, dataset_name, model_suffix, all_models_path
+        )
     else:
         full_network_name = ""
 
-    if os.path.exists(model_path) and (not allow_retrain) and (os.path.exists(model_path + "/best/model.pth")):
+    resume_state = load_training_state(model_path) if resume else None
+
+    if resume_state is not None and resume_state["finished"]:
+        resume_state = None
+
+    if (
+        os.path.exists(model_path)
+        and (not allow_retrain)
+        and (os.path.exists(model_path + "/best/model.pth"))
+        and resume_state is None
+    ):
         print("Already exists", model_path)
         return
 
-    if not os.path.exists(model_path):
-        os.mkdir(model_path)
-    if not os.path.exists(model_path + "/results"):
-        os.mkdir(model_path + "/results")
-    if not os.path.exists(model_path + "/best"):
-        os.mkdir(model_path + "/best")
-    if not os.path.exists(model_path + "/summary"):
-        os.mkdir(model_path + "/summary")
+    rank = get_rank()
+    world_size = get_world_size()
+    distributed = world_size > 1
 
-    writer = SummaryWriter(model_path + "/summary")
+    if is_main_process():
+        create_model_directories(model_path)
+
+    barrier()
+
+    # reading the console values waits for the device, so by default it happens with the summary flushes
+    if log_steps is None:
+        log_steps = summary_steps
 
     if optimizer is None:
         optimizer = "SGD"
@@ -837,7 +1098,8 @@ def train(
             **save_kwargs
         )
 
-    create_current_model_description(model_path)
+    if is_main_process():
+        create_current_model_description(model_path)
 
     if "activation" in kwargs:
         kwargs = process_activation_kwargs(kwargs)
@@ -848,160 +1110,281 @@ def train(
 
     device = torch.device(device if torch.cuda.is_available() else "cpu")
 
-    net: Network = create_network(network_name, network_type)(**kwargs)
+    if shared_runtime:
+        net: Network = SweepRuntime.get_network_factory(network_name, network_type)(**kwargs)
+    else:
+        net = create_network(network_name, network_type)(**kwargs)
 
-    train, val, _ = create_train_validation_test(dataset_params[dataset_name])
+    # all ranks have to agree on the split, so it is seeded in distributed mode,
+    # and the main process downloads and caches the dataset before the others read it
+    if not is_main_process():
+        barrier()
 
-    train = torch.utils.data.DataLoader(  # type: ignore
-        train, batch, shuffle=True, num_workers=4
-    )
-
-    val = torch.utils.data.DataLoader(  # type: ignore
-        val, batch, shuffle=False, num_workers=4
-    )
+    def create_datasets():
+        return create_train_validation_test(
+            dataset_params[dataset_name], dataset_cache, SEED if distributed else None
+        )
 
-    if save_steps < 0:
-        save_steps = -save_steps * len(train)
+    if shared_runtime:
+        train, val, _ = SweepRuntime.get_datasets((dataset_name, dataset_cache, distributed), create_datasets)
+    else:
+        train, val, _ = create_datasets()
 
-    if validation_steps < 0:
-        validation_steps = -validation_steps * len(train)
+    if is_main_process():
+        barrier()
 
-    net.prepare_train(
-        optimizer=optimizers[optimizer],
-        optimizer_params=current_optimizer_params,
-        loss_func=loss_functions[loss](**current_loss_params),
-        loss_uses_network=loss in loss_functions_that_use_network,
-        batch=batch,
-    )
-    net.to(device)
+    if resume_state is not None:
+        data_seed = resume_state["data_seed"]
+    elif distributed:
+        data_seed = SEED
+    else:
+        data_seed = int(torch.randint(0, 2**31 - 1, ()))
+
+    if shared_runtime:
+        train_loader_key = (dataset_name, dataset_cache, "train", batch, rank, world_size)
+        val_loader_key = (dataset_name, dataset_cache, "val", batch)
+
+        train = SweepRuntime.acquire_loader(train_loader_key, lambda: create_data_loader(
+            train, batch, shuffle=True, num_workers=4, rank=rank, world_size=world_size, persistent_workers=True,
+        ))
+        val = SweepRuntime.acquire_loader(val_loader_key, lambda: create_data_loader(
+            val, batch, shuffle=False, num_workers=4, persistent_workers=True,
+        ))
+        set_loader_seed(train, data_seed)
+    else:
+        train = create_data_loader(train, batch, shuffle=True, num_workers=4, rank=rank, world_size=world_size, seed=data_seed)
+        val = create_data_loader(val, batch, shuffle=False, num_workers=4)
 
-    steps_count = len(train) * epochs
+    if is_main_process():
+        writer = BatchedSummaryWriter(SummaryWriter(model_path + "/summary"), summary_steps)
+    else:
+        writer = NullSummaryWriter()
+
+    # the writer is closed and loaders of the shared runtime go back to the pool even if the run fails,
+    # so queued summaries are written and no writer thread is left behind
+    try:
+        if save_steps < 0:
+            save_steps = -save_steps * len(train)
+
+        if validation_steps < 0:
+            validation_steps = -validation_steps * len(train)
+
+        net.prepare_train(
+            optimizer=optimizers[optimizer],
+            optimizer_params=current_optimizer_params,
+            loss_func=loss_functions[loss](**current_loss_params),
+            loss_uses_network=loss in loss_functions_that_use_network,
+            batch=batch,
+        )
+        net.to(device)
+        net.set_precision(precision, channels_last)
+        net.streaming_eval = streaming_eval
+        net.replicated_samples = replicated_samples
+
+        if distributed:
+            broadcast_module(net)
+            net.gradient_reducer = all_reduce_gradients
+
+        if async_checkpoint or keep_checkpoints > 0:
+            net.checkpoint_writer = CheckpointWriter(keep_checkpoints, async_checkpoint)
+
+        if resume_state is not None:
+            net.load_training(model_path, resume_state, device)
+            print("Resuming " + model_path + " from step " + str(resume_state["step"]))
+
+        steps_count = len(train) * epochs
+
+        # training can pause after stop_epoch and resume later, the schedule still spans all epochs
+        end_epoch = epochs if stop_epoch is None else min(stop_epoch, epochs)
+
+        def create_training_state(current_step, epoch, finished_batches, finished=False):
+            return {
+                "step": current_step,
+                "epoch": epoch,
+                "batch": finished_batches,
+                "data_seed": data_seed,
+                "global_std": VariationalBase.GLOBAL_STD,
+                "rng": get_rng_states(),
+                "finished": finished,
+            }
+
+        def run_train():
+            net.train()
+
+            current_step = 0
+            start_epoch = 0
+            start_batch = 0
+            window_accuracy_metric = WindowedAverageMetric(metric_window)
+            loss_metric = ExponentialMovingAverageMetric()
+            throughput_metric = WindowedAverageMetric(metric_window)
+
+            if resume_state is not None:
+                current_step = resume_state["step"]
+                start_epoch = resume_state["epoch"]
+                start_batch = resume_state["batch"]
+                VariationalBase.GLOBAL_STD = resume_state["global_std"]
+                set_rng_states(resume_state["rng"])
+
+            for epoch in range(start_epoch, end_epoch):
+
+                accuracy_metric = AverageMetric()
+                set_loader_epoch(train, epoch)
+                skipped_batches = start_batch if epoch == start_epoch else 0
+                step_start = time.time()
+
+                for i, (data, target) in enumerate(skip_batches(train, skipped_batches), skipped_batches):
+
+                    if start_global_std is not None:
+                        VariationalBase.GLOBAL_STD = start_global_std + (
+                            current_step / steps_count
+                        ) * (end_global_std - start_global_std)
+
+                    data = data.to(device)
+                    target = target.to(device)
+
+                    current_step += 1
+
+                    if train_uncertainty:
+                        loss_dict, correct = net.train_step_uncertainty(
+                            data, target, correct_count=correct_count
+                        )
+                    else:
+                        loss_dict, correct = net.train_step(
+                            data, target, correct_count=correct_count, samples=samples, sync_loss=False,
+                        )
 
-    def run_train():
-        net.train()
+                    step_end = time.time()
+                    throughput_metric.update(len(data) / (step_end - step_start))
+                    step_start = step_end
 
-        current_step = 0
+                    # metrics stay on the device, values are read only for console and summary flushes
+                    accuracy_metric.update(correct / batch)
+                    window_accuracy_metric.update(correct / batch)
+                    loss_metric.update(loss_dict["loss"])
 
-        for epoch in range(epochs):
+                    for loss, value in loss_dict.items():
+                        writer.add_scalar(loss, value, current_step)
 
-            accuracy_metric = AverageMetric()
+                    writer.add_scalar("acc", accuracy_metric.get(), current_step)
+                    writer.add_scalar("window_acc", window_accuracy_metric.get(), current_step)
+                    writer.add_scalar("loss_ema", loss_metric.get(), current_step)
+                    writer.add_scalar("epoch", epoch + 1, current_step)
+                    writer.add_scalar("samples_per_second", throughput_metric.get(), current_step)
 
-            for i, (data, target) in enumerate(train):
+                    if start_global_std is not None:
+                        writer.add_scalar(
+                            "Global_STD", VariationalBase.GLOBAL_STD, current_step
+                        )
 
-                if start_global_std is not None:
-                    VariationalBase.GLOBAL_STD = start_global_std + (
-                        current_step / steps_count
-                    ) * (end_global_std - start_global_std)
+                    writer.step()
+
+                    if current_step % log_steps == 0:
+
+                        if distributed:
+                            rank_throughputs = all_gather_values(throughput_metric.get())
+
+                            for r, value in enumerate(rank_throughputs):
+                                writer.add_scalar("rank_" + str(r) + "/samples_per_second", value, current_step)
+
+                            writer.add_scalar("total_samples_per_second", sum(rank_throughputs), current_step)
+
+                        log = (
+                            full_network_name
+                            + " e["
+                            + str(epoch + 1)
+                            + "/"
+                            + str(epochs)
+                            + "]"
+                            + " s["
+                            + str(i + 1)
+                            + "/"
+                            + str(len(train))
+                            + "]"
+                            + ", ".join(
+                                [str(k) + "=" + str(float(loss_dict[k])) for k in loss_dict.keys()]
+                            )
+                            + " acc="
+                            + str(float(accuracy_metric.get()))
+                        )
 
-                data = data.to(device)
-                target = target.to(device)
+                        if start_global_std is not None:
+                            log += " g_std=" + str(VariationalBase.GLOBAL_STD)
 
-                current_step += 1
+                        log += " sps=" + str(round(throughput_metric.get(), 1))
 
-                if train_uncertainty:
-                    loss_dict, correct = net.train_step_uncertainty(
-                        data, target, correct_count=correct_count
-                    )
-                else:
-                    loss_dict, correct = net.train_step(
-                        data, target, correct_count=correct_count, samples=samples,
-                    )
+                        if distributed:
+                            log = "r[" + str(rank) + "] " + log + " total_sps=" + str(round(sum(rank_throughputs), 1))
 
-                accuracy_metric.update(float(correct) / batch)
-
-                log = (
-                    full_network_name
-                    + " e["
-                    + str(epoch + 1)
-                    + "/"
-                    + str(epochs)
-                    + "]"
-                    + " s["
-                    + str(i + 1)
-                    + "/"
-                    + str(len(train))
-                    + "]"
-                    + ", ".join(
-                        [str(k) + "=" + str(loss_dict[k]) for k in loss_dict.keys()]
-                    )
-                    + " acc="
-                    + str(accuracy_metric.get())
-                )
+                        print("{:<80}".format(log), end="\n")
 
-                for loss, value in loss_dict.items():
-                    writer.add_scalar(loss, value, current_step)
+                    if distributed and (current_step % save_steps == 0 or current_step % validation_steps == 0):
+                        # batch norm statistics are local to each rank
+                        average_buffers(net)
 
-                writer.add_scalar("acc", accuracy_metric.get(), current_step)
-                writer.add_scalar("epoch", epoch + 1, current_step)
+                    if current_step % save_steps == 0 and is_main_process():
+                        net.save(model_path, current_step, create_training_state(current_step, epoch, i + 1))
 
-                if start_global_std is not None:
-                    log += " g_std=" + str(VariationalBase.GLOBAL_STD)
-                    writer.add_scalar(
-                        "Global_STD", VariationalBase.GLOBAL_STD, current_step
-                    )
+                    if current_step % validation_steps == 0 and is_main_process():
+                        val_acc = run_evaluation(net, val, device, correct_count, batch, samples)
+                        record_validation(
+                            net, val_acc, model_path, writer, epoch, current_step, validation_steps % len(train) == 0,
+                            batch, samples, save_best, create_current_model_description,
+                        )
 
-                print("{:<80}".format(log), end="\n")
+                    # the other ranks wait here while the main process saves and validates,
+                    # instead of inside the gradient reduction of the next step
+                    if distributed and (current_step % save_steps == 0 or current_step % validation_steps == 0):
+                        barrier()
 
-                if current_step % save_steps == 0:
-                    net.save(model_path)
+            return current_step
 
-                if current_step % validation_steps == 0:
-                    val_acc = run_evaluation(net, val, device, correct_count, batch, samples)
+        final_step = run_train()
 
-                    if validation_steps % len(train) == 0:
-                        text = "epoch " + str(epoch + 1) + ": "
-                    else:
-                        text = "step " + str(current_step) + ": "
+        if is_main_process():
+            # marks the run as complete, so a resume does not repeat it
+            net.save(model_path, final_step, create_training_state(final_step, end_epoch, 0, finished=end_epoch >= epochs))
 
-                    text += str(val_acc)
+        if net.checkpoint_writer is not None:
+            net.checkpoint_writer.close()
+    finally:
+        writer.close()
 
-                    writer.add_scalar(
-                        "val_acc",
-                        (val_acc[0] if isinstance(val_acc, tuple) else val_acc),
-                        current_step,
-                    )
+        if shared_runtime:
+            SweepRuntime.release_loader(train_loader_key, train)
+            SweepRuntime.release_loader(val_loader_key, val)
 
-                    with open(
-                        model_path + "/results/validation_batch_" + str(batch) + "samples_" + str(samples) + ".txt",
-                        "a",
-                    ) as f:
-                        f.write(text + "\n")
+    barrier()
 
-                    best_description = get_best_description(
-                        model_path + "/best/description.json"
-                    )
 
-                    is_should_save_best = False
+def run_distributed_worker(rank, world_size, port, timeout_minutes, args, kwargs):
 
-                    if best_description is None:
-                        is_should_save_best = True
-                    else:
-                        is_should_save_best = best_description["result"] * 1.001 < (
-                            val_acc[0] if isinstance(val_acc, tuple) else val_acc
-                        )
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
 
-                    if is_should_save_best and save_best:
-                        print(":::Saving Best:::")
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    dist.init_process_group(
+        "gloo", rank=rank, world_size=world_size, timeout=datetime.timedelta(minutes=timeout_minutes)
+    )
 
-                        net.save(model_path + "/best")
+    try:
+        train(*args, **kwargs)
+    finally:
+        destroy_process_group()
 
-                        data = {
-                            "epoch": epoch + 1,
-                            "batch": batch,
-                            "samples": samples,
-                            "result": (
-                                val_acc[0] if isinstance(val_acc, tuple) else val_acc
-                            ),
-                        }
 
-                        with open(model_path + "/best/description.json", "w") as file:
-                            json.dump(data, file)
+def distributed_train(*args, world_size: int = 2, port: int = 29500, timeout_minutes: int = 120, **kwargs):
 
-                        create_current_model_description(model_path + "/best")
+    # started by torchrun, the process group comes from the environment,
+    # the timeout covers the other ranks waiting for validations of the main process
+    if "WORLD_SIZE" in os.environ:
+        dist.init_process_group("gloo", timeout=datetime.timedelta(minutes=timeout_minutes))
 
-                        print(":::Saved Best:::")
+        try:
+            return train(*args, **kwargs)
+        finally:
+            destroy_process_group()
 
-    run_train()
+    mp.spawn(run_distributed_worker, args=(world_size, port, timeout_minutes, args, kwargs), nprocs=world_size)
 
 
 if __name__ == "__main__":
@@ -35,15 +35,16 @@ class AverageMetric(Metric):
     def __init__(self) -> None:
         super().__init__()
 
-        self.value = []
+        self.value = 0
+        self.count = 0
         self.to_skip = 0
 
     def get(self, default=None):
 
-        if len(self.value) == 0 and default is not None:
+        if self.count == 0 and default is not None:
             return default
 
-        return sum(self.value) / len(self.value)
+        return self.value / self.count
 
     def update(self, value):
 
@@ -51,15 +52,75 @@ class AverageMetric(Metric):
             self.to_skip -= 1
             return
 
-        self.value.append(value)
+        self.value = self.value + value
+        self.count += 1
 
     def clear(self):
-        self.value = []
+        self.value = 0
+        self.count = 0
 
     def skip(self, amount):
         self.to_skip = amount
 
 
+class WindowedAverageMetric(AverageMetric):
+    def __init__(self, window=100) -> None:
+        super().__init__()
+
+        self.window = window
+        self.buffer = [0] * window
+        self.position = 0
+
+    def update(self, value):
+
+        if self.to_skip > 0:
+            self.to_skip -= 1
+            return
+
+        if self.count < self.window:
+            self.count += 1
+        else:
+            self.value = self.value - self.buffer[self.position]
+
+        self.buffer[self.position] = value
+        self.value = self.value + value
+        self.position = (self.position + 1) % self.window
+
+        if self.position == 0:
+            # resum once per window so float drift does not build up
+            self.value = sum(self.buffer)
+
+    def clear(self):
+        super().clear()
+        self.buffer = [0] * self.window
+        self.position = 0
+
+
+class ExponentialMovingAverageMetric(Metric):
+    def __init__(self, decay=0.99) -> None:
+        super().__init__()
+
+        self.decay = decay
+        self.value = 0
+        self.count = 0
+
+    def get(self, default=None):
+
+        if self.count == 0 and default is not None:
+            return default
+
+        # bias correction for the zero initialization
+        return self.value / (1 - self.decay**self.count)
+
+    def update(self, value):
+        self.value = self.decay * self.value + (1 - self.decay) * value
+        self.count += 1
+
+    def clear(self):
+        self.value = 0
+        self.count = 0
+
+
 class MaxMetric(Metric):
     def __init__(self) -> None:
         super().__init__()
@@ -119,6 +180,87 @@ class MeanStdMetric(Metric):
         self.value = []
 
 
+def copy_value(value):
+
+    if isinstance(value, Tensor):
+        return value.clone()
+    elif isinstance(value, np.ndarray):
+        return value.copy()
+
+    return value
+
+
+class OnlineMeanStdMetric(Metric):
+    def __init__(self, inplace=False) -> None:
+        super().__init__()
+
+        # inplace updates avoid allocations but break autograd graphs
+        self.inplace = inplace
+        self.clear()
+
+    def get(self, eps=1e-5):
+
+        variance = self.variance()
+
+        if isinstance(variance, np.ndarray):
+            std = np.sqrt(variance + eps)
+        elif isinstance(variance, Tensor):
+            std = torch.sqrt(variance + eps)
+        else:
+            std = math.sqrt(variance + eps)
+
+        return (self.mean, std)
+
+    def variance(self):
+
+        # an empty metric and a single value have no spread, zero keeps the shape of the values
+        if self.count < 2:
+            return 0 if self.count == 0 else self.squares * 0
+
+        return self.squares / self.count
+
+    def update(self, value):
+
+        self.count += 1
+
+        if self.count == 1:
+            self.mean = copy_value(value)
+            self.squares = value * 0
+        elif self.inplace:
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.squares += delta * (value - self.mean)
+        else:
+            delta = value - self.mean
+            self.mean = self.mean + delta / self.count
+            self.squares = self.squares + delta * (value - self.mean)
+
+    def merge(self, other: "OnlineMeanStdMetric"):
+
+        # parallel update of Chan et al., combines states of partial streams
+        if other.count == 0:
+            return self
+
+        if self.count == 0:
+            # copies, so that inplace updates of this metric do not change other
+            self.count, self.mean, self.squares = other.count, copy_value(other.mean), copy_value(other.squares)
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+
+        self.mean = self.mean + delta * (other.count / count)
+        self.squares = self.squares + other.squares + delta**2 * (self.count * other.count / count)
+        self.count = count
+
+        return self
+
+    def clear(self):
+        self.count = 0
+        self.mean = None
+        self.squares = None
+
+
 class RangeMetric(Metric):
     def __init__(self, delimiter=", ", value_separator=": ") -> None:
         super().__init__()
@@ -1,7 +1,18 @@
 
 
+import json
+import multiprocessing
+import os
+import queue as queue_module
+import socket
+import time
+import traceback
+from threading import Thread
 import fire
-from main import train
+import torch
+from main import create_model_path, train
+from stacked_trials import is_stackable_key, train_stacked
+from work_queue import WorkQueue, is_completed, rung_epochs, validation_score
 
 
 def create_vnn_model_kwargs(epochs):
@@ -414,7 +425,7 @@ def create_models(datasets, network_types):
     return all_models
 
 
-def run(network_types="all", id=0, gpu_capacity=4, total_devices=4, datasets=["mnist"]):
+def run(network_types="all", id=0, gpu_capacity=4, total_devices=4, datasets=["mnist"], resume=True, shared_runtime=True):
 
     device_id = id % total_devices
     i = id
@@ -425,7 +436,10 @@ def run(network_types="all", id=0, gpu_capacity=4, total_devices=4, datasets=["m
         network_name, dataset_name, kwargs = all_models[i]
 
         try:
-            train(network_name=network_name, dataset_name=dataset_name, allow_retrain=False, device="cuda:" + str(device_id), **kwargs)
+            train(
+                network_name=network_name, dataset_name=dataset_name, allow_retrain=False,
+                device="cuda:" + str(device_id), resume=resume, shared_runtime=shared_runtime, **kwargs,
+            )
         except Exception as e:
             print("ERROR:", e)
             with open("modeling_errors.txt", "a") as f:
@@ -444,7 +458,7 @@ def run(network_types="all", id=0, gpu_capacity=4, total_devices=4, datasets=["m
     print()
 
 
-def run_indexed(network_types="all", index=0, output_dir="./models", datasets=["cifar10"]):
+def run_indexed(network_types="all", index=0, output_dir="./models", datasets=["cifar10"], resume=True):
 
     i = index
 
@@ -453,7 +467,7 @@ def run_indexed(network_types="all", index=0, output_dir="./models", datasets=["
     network_name, dataset_name, kwargs = all_models[i]
 
     try:
-        train(network_name=network_name, dataset_name=dataset_name, allow_retrain=False, device="cuda", all_models_path=output_dir, **kwargs)
+        train(network_name=network_name, dataset_name=dataset_name, allow_retrain=False, device="cuda", all_models_path=output_dir, resume=resume, **kwargs)
     except Exception as e:
         print("ERROR:", e)
         with open(f"{output_dir}/modeling_errors.txt", "a") as f:
@@ -469,6 +483,253 @@ def run_indexed(network_types="all", index=0, output_dir="./models", datasets=["
     print()
 
 
+def enqueue(network_types="all", datasets=["mnist"], queue_path="./models/queue.sqlite", output_dir="./models"):
+
+    queue = WorkQueue(queue_path)
+    models = []
+    skipped = 0
+
+    for network_name, dataset_name, kwargs in create_models(datasets, network_types):
+        model_path, _ = create_model_path(
+            network_name, kwargs["network_type"], dataset_name, kwargs.get("model_suffix", ""), output_dir
+        )
+
+        if is_completed(model_path):
+            skipped += 1
+        else:
+            models.append((network_name, dataset_name, kwargs))
+
+    added = queue.enqueue(models)
+
+    print("Added", added, "jobs, skipped", skipped, "completed models")
+    print(queue.counts())
+
+
+def run_job(job, results, threads=None, **train_kwargs):
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    start = time.time()
+
+    try:
+        train(
+            network_name=job.network_name, dataset_name=job.dataset_name, allow_retrain=False,
+            **train_kwargs, **job.kwargs,
+        )
+        results.put((job.id, time.time() - start, None))
+    except Exception:
+        results.put((job.id, time.time() - start, traceback.format_exc()))
+
+
+def work(
+    queue_path="./models/queue.sqlite",
+    output_dir="./models",
+    device="cuda",
+    pack=1,
+    pack_seconds=300,
+    threads=None,
+    max_attempts=3,
+    backoff=60,
+    stale_seconds=3600,
+    poll_seconds=30,
+    resume=True,
+    shared_runtime=True,
+    reduction=None,
+    min_epochs=1,
+):
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    queue = WorkQueue(queue_path)
+    worker = socket.gethostname() + ":" + str(os.getpid())
+
+    # packed jobs run in their own processes, since train relies on global state like the torch rng,
+    # the global std and the layer ensemble collection, a job running alone stays in this process
+    # and keeps the shared runtime
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    finished = []
+    running = {}
+    last_heartbeat = time.time()
+
+    while True:
+
+        exited = [id for id, (_, runner, packed) in running.items() if packed and not runner.is_alive()]
+
+        while True:
+            try:
+                finished.append(results.get_nowait())
+            except queue_module.Empty:
+                break
+
+        finished_ids = [id for id, _, _ in finished]
+
+        # a process that was killed never reports a result
+        for id in exited:
+            if id not in finished_ids:
+                finished.append((id, 0, "Job process exited with code " + str(running[id][1].exitcode)))
+
+        for id, duration, error in finished:
+            job, runner, _ = running.pop(id)
+            runner.join()
+
+            if error is None and reduction is not None:
+                stop_epoch = rung_epochs(job.rung, min_epochs, reduction, job.kwargs["epochs"])
+                model_path, _ = create_model_path(
+                    job.network_name, job.kwargs["network_type"], job.dataset_name,
+                    job.kwargs.get("model_suffix", ""), output_dir,
+                )
+                score = validation_score(model_path, stop_epoch)
+                queue.record_rung(job, score, duration, stop_epoch >= job.kwargs["epochs"])
+                print("Finished", job.name(), "rung", job.rung, "epoch", stop_epoch, "score", score)
+            elif error is None:
+                queue.complete(job, duration)
+                print("Finished", job.name(), "in", round(duration, 1), "s")
+            else:
+                status = queue.fail(job, error, max_attempts, backoff)
+                print("ERROR:", job.name(), status, error)
+
+        finished = []
+
+        if time.time() - last_heartbeat > stale_seconds / 4:
+            queue.heartbeat(worker)
+            last_heartbeat = time.time()
+
+        job = None
+
+        if len(running) == 0:
+            job = queue.claim(worker, stale_seconds, max_attempts, reduction=reduction)
+        elif len(running) < pack and all(packed for _, _, packed in running.values()):
+
+            # small runs share the worker, as long as their measured cost stays below pack_seconds
+            packable_groups = [
+                group for group, cost in queue.expected_costs().items() if cost <= pack_seconds
+            ]
+
+            if len(packable_groups) > 0:
+                job = queue.claim(worker, stale_seconds, max_attempts, packable_groups, reduction)
+
+        if job is not None:
+            model_path, _ = create_model_path(
+                job.network_name, job.kwargs["network_type"], job.dataset_name,
+                job.kwargs.get("model_suffix", ""), output_dir,
+            )
+
+            if is_completed(model_path):
+                queue.complete(job)
+                print("Already completed", job.name())
+                continue
+
+            cost = queue.expected_costs().get(job.group)
+            packed = (
+                pack > 1 and cost is not None and cost <= pack_seconds
+                and job.kwargs.get("start_global_std") is None
+            )
+
+            train_kwargs = {
+                "device": device, "all_models_path": output_dir, "resume": resume,
+                "shared_runtime": shared_runtime and not packed,
+            }
+
+            # successive halving trains each rung up to its epoch budget and resumes from there when promoted
+            if reduction is not None:
+                train_kwargs["resume"] = True
+                train_kwargs["stop_epoch"] = rung_epochs(job.rung, min_epochs, reduction, job.kwargs["epochs"])
+
+            if packed:
+                runner = context.Process(
+                    target=run_job, args=(job, results, threads), kwargs=train_kwargs
+                )
+            else:
+                runner = Thread(target=run_job, args=(job, results), kwargs=train_kwargs, daemon=True)
+
+            running[job.id] = (job, runner, packed)
+            runner.start()
+            print("Started", job.name(), "packed" if packed else "")
+            continue
+
+        if len(running) == 0:
+            counts = queue.counts()
+
+            if counts.get("pending", 0) + counts.get("running", 0) == 0:
+                break
+
+        try:
+            finished.append(results.get(timeout=poll_seconds))
+        except queue_module.Empty:
+            pass
+
+    print(queue.counts())
+
+
+def queue_status(queue_path="./models/queue.sqlite"):
+
+    queue = WorkQueue(queue_path)
+
+    print(queue.counts())
+
+    for group, cost in sorted(queue.expected_costs().items()):
+        print(group, round(cost, 1), "s")
+
+    for id, network_name, kwargs, attempts, error in queue.errors():
+        print("FAILED", id, network_name, kwargs, "attempts=" + str(attempts))
+        print(error)
+
+
+def create_stacked_groups(all_models, seeds=None, max_trials=16):
+
+    # configurations that differ only in stackable keys train together as one stack
+    groups: dict = {}
+
+    for network_name, dataset_name, kwargs in all_models:
+        shared = {key: value for key, value in kwargs.items() if not is_stackable_key(key)}
+        trial = {key: value for key, value in kwargs.items() if is_stackable_key(key)}
+        key = json.dumps([network_name, dataset_name, shared], sort_keys=True)
+        trials = groups.setdefault(key, (network_name, dataset_name, shared, []))[3]
+
+        if seeds is None:
+            trials.append(trial)
+        else:
+            for seed in seeds:
+                trials.append({**trial, "seed": seed, "model_suffix": trial["model_suffix"] + "-seed" + str(seed)})
+
+    result = []
+
+    for network_name, dataset_name, shared, trials in groups.values():
+        for i in range(0, len(trials), max_trials):
+            result.append((network_name, dataset_name, shared, trials[i:i + max_trials]))
+
+    return result
+
+
+def run_stacked(network_types=["classic"], datasets=["mnist"], seeds=None, max_trials=16, output_dir="./models", device="cuda"):
+
+    all_models = create_models(datasets, network_types)
+
+    for network_name, dataset_name, shared, trials in create_stacked_groups(all_models, seeds, max_trials):
+        try:
+            train_stacked(
+                network_name=network_name, dataset_name=dataset_name, trials=trials, allow_retrain=False,
+                device=device, all_models_path=output_dir, shared_runtime=True, **shared,
+            )
+        except ValueError as e:
+            # network types and losses that can not be stacked train one trial at a time
+            print("Not stacked:", e)
+
+            for trial in trials:
+                trial = dict(trial)
+
+                if "seed" in trial:
+                    torch.manual_seed(trial.pop("seed"))
+
+                train(
+                    network_name=network_name, dataset_name=dataset_name, allow_retrain=False,
+                    device=device, all_models_path=output_dir, shared_runtime=True, **shared, **trial,
+                )
+
+
 if __name__ == "__main__":
 
     fire.Fire()
@@ -0,0 +1,210 @@
+import os
+import random
+import shutil
+from queue import Queue
+from threading import Thread
+import numpy as np
+import torch
+
+
+def snapshot(value):
+
+    # copies every tensor to the cpu, so training can keep changing the originals
+    if isinstance(value, torch.Tensor):
+        return value.detach().to("cpu", copy=True)
+    elif isinstance(value, dict):
+        return type(value)((key, snapshot(val)) for key, val in value.items())
+    elif isinstance(value, (list, tuple)):
+        return type(value)(snapshot(val) for val in value)
+
+    return value
+
+
+def atomic_save(value, path):
+
+    temp_path = path + ".tmp"
+
+    with open(temp_path, "wb") as f:
+        torch.save(value, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_path, path)
+
+
+def atomic_link(source, path):
+
+    temp_path = path + ".tmp"
+
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+
+    os.replace(temp_path, path)
+
+
+def atomic_write_text(text, path):
+
+    temp_path = path + ".tmp"
+
+    with open(temp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_path, path)
+
+
+def latest_checkpoint_path(load_path):
+
+    # runs saved before the pointer file keep their training files next to the model
+    pointer_path = load_path + "/latest"
+
+    if not os.path.exists(pointer_path):
+        return load_path
+
+    with open(pointer_path) as f:
+        return load_path + "/checkpoints/" + f.read().strip()
+
+
+def write_checkpoint(save_path, files, step=None, keep=0):
+
+    if not os.path.exists(save_path):
+        os.mkdir(save_path)
+
+    # training states are resumed together with their model and optimizer,
+    # so they always go through a step directory and the latest pointer
+    resumable = "training_state.pth" in files and step is not None
+
+    if not resumable and (step is None or keep <= 0):
+        for name, value in files.items():
+            atomic_save(value, save_path + "/" + name)
+
+        return
+
+    checkpoints_path = save_path + "/checkpoints"
+    step_path = checkpoints_path + "/" + str(step)
+
+    if not os.path.exists(step_path):
+        os.makedirs(step_path)
+
+    for name, value in files.items():
+        atomic_save(value, step_path + "/" + name)
+
+    # the pointer publishes the whole set at once, a crash before it leaves the previous step in place
+    if resumable:
+        atomic_write_text(str(step), save_path + "/latest")
+
+    # the latest files are hard links to the newest step, so nothing is written twice
+    for name in files.keys():
+        if name != "training_state.pth":
+            atomic_link(step_path + "/" + name, save_path + "/" + name)
+
+    # a retrained run starts again from low steps, so steps above the current one are stale
+    steps = sorted(int(name) for name in os.listdir(checkpoints_path) if name.isdigit())
+    kept = [old_step for old_step in steps if old_step < step][-(keep - 1):] if keep > 1 else []
+
+    for old_step in steps:
+        if old_step != step and old_step not in kept:
+            shutil.rmtree(checkpoints_path + "/" + str(old_step))
+
+
+def get_rng_states():
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "numpy": np.random.get_state(),
+        "random": random.getstate(),
+    }
+
+
+def set_rng_states(states):
+
+    torch.set_rng_state(states["torch"])
+
+    if states["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+    np.random.set_state(states["numpy"])
+    random.setstate(states["random"])
+
+
+def load_training_state(load_path):
+
+    path = latest_checkpoint_path(load_path) + "/training_state.pth"
+
+    if not os.path.exists(path):
+        return None
+
+    # rng states hold numpy arrays and python tuples
+    return torch.load(path, weights_only=False)
+
+
+class CheckpointWriter:
+    def __init__(self, keep=0, asynchronous=True) -> None:
+        self.keep = keep
+        self.asynchronous = asynchronous
+        self.error = None
+
+        if asynchronous:
+            self.queue: Queue = Queue()
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def save(self, save_path, files, step=None):
+
+        if not self.asynchronous:
+            write_checkpoint(save_path, files, step, self.keep)
+            return
+
+        if self.error is not None:
+            raise self.error
+
+        self.queue.put((write_checkpoint, (save_path, snapshot(files), step, self.keep)))
+
+    def submit(self, function):
+
+        if not self.asynchronous:
+            function()
+            return
+
+        self.queue.put((function, ()))
+
+    def run(self):
+
+        while True:
+            task = self.queue.get()
+
+            if task is None:
+                self.queue.task_done()
+                return
+
+            function, args = task
+
+            try:
+                function(*args)
+            except Exception as e:
+                self.error = e
+                print("Checkpoint writing failed: " + str(e))
+
+            self.queue.task_done()
+
+    def wait(self):
+
+        if self.asynchronous:
+            self.queue.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+
+        self.wait()
+
+        if self.asynchronous:
+            self.queue.put(None)
+            self.thread.join()
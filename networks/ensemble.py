@@ -2,18 +2,35 @@ from torch import nn
 import torch
 
 from networks.network import Network
+from networks.stacked import StackedModules, stacked_forward
 
 
 class EnsembleNetwork(Network):
-    def __init__(self, networks, priors, prior_scale) -> None:
+    def __init__(self, networks, priors, prior_scale, fused_prior=False, vectorized=False) -> None:
         super().__init__()
         self.networks = nn.ModuleList(networks)
         self.priors = nn.ModuleList(priors)
         self.prior_scale = prior_scale
+        self.fused_prior = fused_prior
+        self.vectorized = vectorized
+
+        # the batch can only be repeated for samples if every member draws its noise per batch element
+        self.batch_samples = all(network.batch_samples for network in networks)
+
+        self.stacked_networks = StackedModules(list(networks))
+        self.stacked_priors = StackedModules(list(priors))
+        self.stacked_all = StackedModules([*networks, *priors])
 
     def forward(self, x):
 
+        if self.vectorized:
+            return self.vectorized_forward(x)
+
         def output_with_prior(network, prior):
+            if self.prior_scale > 0 and self.fused_prior:
+                result, prior_result = stacked_forward([network, prior], x)
+                return result + prior_result * self.prior_scale
+
             result = network(x)
             if self.prior_scale > 0:
                 return result + prior(x) * self.prior_scale
@@ -23,8 +40,23 @@ class EnsembleNetwork(Network):
         result = torch.mean(torch.stack([output_with_prior(network, prior) for network, prior in zip(self.networks, self.priors)]), dim=0)
         return result
 
+    def vectorized_forward(self, x):
+
+        if self.prior_scale > 0 and self.fused_prior:
+            outputs = self.stacked_all(x)
+            count = len(self.networks)
+            result = outputs[:count] + outputs[count:] * self.prior_scale
+        else:
+            result = self.stacked_networks(x)
+
+            if self.prior_scale > 0:
+                result = result + self.stacked_priors(x) * self.prior_scale
+
+        result = torch.mean(result, dim=0)
+        return result
+
 
-def create_ensemble(network_creator, num_ensemble=10, prior_scale=1, **kwargs):
+def create_ensemble(network_creator, num_ensemble=10, prior_scale=1, fused_prior=False, vectorized=False, **kwargs):
     networks = [network_creator(**kwargs) for _ in range(num_ensemble)]
     if prior_scale > 0: 
         priors = [network_creator(**kwargs) for _ in range(num_ensemble)]
@@ -32,6 +64,6 @@ def create_ensemble(network_creator, num_ensemble=10, prior_scale=1, **kwargs):
     else:
         priors = [nn.Identity() for _ in range(num_ensemble)]
 
-    result = EnsembleNetwork(networks, priors, prior_scale)
+    result = EnsembleNetwork(networks, priors, prior_scale, fused_prior, vectorized)
 
     return result
\ No newline at end of file
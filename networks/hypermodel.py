@@ -12,6 +12,10 @@ def get_shapes(network: Network):
 
 
 class HypermodelNetwork(Network):
+
+    # hyperweights are shared by the whole batch
+    batch_samples = False
+
     def __init__(self, base, hypertorso_creator, index_dim, index_scale=0, scale_weights=False, shape_index=False) -> None:
         super().__init__()
         self.base = base
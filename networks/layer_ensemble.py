@@ -2,10 +2,13 @@ from typing import Any, List, Optional, Literal, Tuple, Union
 from torch import nn
 import torch
 import numpy as np
+import itertools
+from collections import OrderedDict
 from core import Flatten
 from time import time
 
 from networks.network import Network
+from networks.stacked import stacked_forward
 
 
 class LayerEnsembleBase(nn.Module):
@@ -25,12 +28,13 @@ class LayerEnsembleBase(nn.Module):
         use_batch_norm: bool = False,
         batch_norm_eps: float = 1e-3,
         batch_norm_momentum: float = 0.01,
+        num_ensemble: Optional[int] = None,
     ) -> None:
 
         super().__init__()
 
         self.ensembles = ensembles
-        self.num_ensemble = len(ensembles)
+        self.num_ensemble = len(ensembles) if num_ensemble is None else num_ensemble
         self.suffix = nn.Identity()
         self.sample = None
 
@@ -55,12 +59,29 @@ class LayerEnsembleBase(nn.Module):
         if sample is None:
             raise Exception("No sample provided")
 
-        result = self.ensembles[sample](input)
+        if isinstance(sample, PrefixSharedSample):
+            self.sample = None
+            return sample.executor.forward(self, sample.index, input)
+
+        if isinstance(sample, (int, np.integer)):
+            result = self.forward_member(input, int(sample))
+        else:
+            result = self.forward_members(input, sample)
+
         result = self.suffix(result)
 
         self.sample = None
         return result
 
+    def forward_member(self, input, sample):
+        return self.ensembles[sample](input)
+
+    def forward_members(self, input, samples):
+        # input holds len(samples) sample-major blocks stacked along the batch
+        inputs = input.reshape(len(samples), -1, *input.shape[1:])
+        result = torch.cat([self.ensembles[int(q)](x) for q, x in zip(samples, inputs)])
+        return result
+
     @staticmethod
     def collect():
         result = LayerEnsembleBase.__COLLECTION
@@ -68,6 +89,176 @@ class LayerEnsembleBase(nn.Module):
 
         return result
 
+class SamplePlan:
+    def __init__(self, samples) -> None:
+
+        self.samples = np.asarray(samples, dtype=np.int64)
+        self.layer_tensors = {}
+        self.node_cache = {}
+
+        # plans drawn for a single forward call only pay for what they use
+        self._members = None
+        self._boundaries = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def members(self):
+
+        if self._members is None:
+            self._members = [np.unique(self.samples[:, i]) for i in range(self.samples.shape[-1])]
+
+        return self._members
+
+    @property
+    def boundaries(self):
+
+        # boundaries[i] holds the first row of every group of samples
+        # sharing the same members in layers 0..i (samples are lexsorted)
+        if self._boundaries is None:
+            changed = np.logical_or.accumulate(np.diff(self.samples, axis=0) != 0, axis=1)
+            self._boundaries = [
+                np.concatenate([[0], np.flatnonzero(changed[:, i]) + 1]) for i in range(self.samples.shape[-1])
+            ]
+
+        return self._boundaries
+
+    def layer_samples(self, index, device):
+
+        key = (index, str(device))
+
+        if key not in self.layer_tensors:
+            self.layer_tensors[key] = torch.as_tensor(self.samples[:, index], device=device)
+
+        return self.layer_tensors[key]
+
+    def nodes(self, columns):
+
+        key = tuple(columns)
+
+        if key not in self.node_cache:
+            if key == tuple(range(len(key))):
+                representatives = self.boundaries[len(key) - 1]
+                sizes = np.diff(np.append(representatives, len(self.samples)))
+                inverse = np.repeat(np.arange(len(representatives)), sizes)
+            else:
+                _, representatives, inverse = np.unique(
+                    self.samples[:, list(key)], axis=0, return_index=True, return_inverse=True
+                )
+
+            self.node_cache[key] = (representatives, inverse.reshape(-1))
+
+        return self.node_cache[key]
+
+
+class SamplePlanCache:
+    def __init__(self, max_size=32) -> None:
+        self.max_size = max_size
+        self.plans: "OrderedDict[Tuple, SamplePlan]" = OrderedDict()
+
+    def get(self, num_ensembles, num_samples, seed):
+
+        key = (tuple(num_ensembles), num_samples, seed)
+
+        if key in self.plans:
+            self.plans.move_to_end(key)
+        else:
+            rng = np.random.RandomState(seed)
+            self.plans[key] = SamplePlan(sample_layer_ensembles(num_ensembles, num_samples, rng))
+
+            if len(self.plans) > self.max_size:
+                self.plans.popitem(last=False)
+
+        return self.plans[key]
+
+    def clear(self):
+        self.plans = OrderedDict()
+
+
+class PrefixSharedSample:
+    def __init__(self, executor, index) -> None:
+        self.executor = executor
+        self.index = index
+
+
+class PrefixSharingExecutor:
+    def __init__(self, plan: SamplePlan) -> None:
+        self.plan = plan
+        self.executed: List[int] = []
+        self.evaluations = 0
+        self.saved_evaluations = 0
+
+    def select(self, collection):
+        assert self.plan.samples.shape[-1] == len(collection)
+
+        for i, layer in enumerate(collection):
+            layer.sample = PrefixSharedSample(self, i)
+
+    def nodes(self, index):
+
+        # samples that agree on every layer evaluated so far in this pass
+        # share the input of the current layer and form one trie node
+        self.executed.append(index)
+        return self.plan.nodes(self.executed)
+
+    def forward(self, layer, index, input):
+
+        count = len(self.plan)
+        representatives, inverse = self.nodes(index)
+
+        self.evaluations += len(representatives)
+        self.saved_evaluations += count - len(representatives)
+
+        x = input.reshape(count, -1, *input.shape[1:])
+        x = x[torch.as_tensor(representatives, device=input.device)]
+        x = x.reshape(-1, *x.shape[2:])
+
+        result = layer.forward_members(x, self.plan.samples[representatives, index])
+        result = layer.suffix(result)
+
+        result = result.reshape(len(representatives), -1, *result.shape[1:])
+        result = result[torch.as_tensor(inverse, device=result.device)]
+        result = result.reshape(-1, *result.shape[2:])
+
+        return result
+
+
+class StackedLayerEnsembleBase(LayerEnsembleBase):
+    def build_stacked(
+        self,
+        members: List[nn.Module],
+        batch_norm_module: Any,
+        batch_norm_size: int,
+        **kwargs,
+    ) -> None:
+
+        super().build(
+            None, batch_norm_module, batch_norm_size, num_ensemble=len(members), **kwargs
+        )
+
+        self.weight = nn.Parameter(torch.stack([m.weight.data for m in members]))
+
+        if members[0].bias is None:
+            self.register_parameter("bias", None)
+        else:
+            self.bias = nn.Parameter(torch.stack([m.bias.data for m in members]))
+
+    def member_parameters(self, sample):
+        return self.weight[sample], (None if self.bias is None else self.bias[sample])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+
+        # checkpoints of LayerEnsembleLinear/Convolution keep one module per member
+        for name in ["weight", "bias"]:
+            keys = [prefix + "ensembles." + str(i) + "." + name for i in range(self.num_ensemble)]
+
+            if (prefix + name) not in state_dict and all(k in state_dict for k in keys):
+                state_dict[prefix + name] = torch.stack([state_dict.pop(k) for k in keys])
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
 class LayerEnsembleConvolution(LayerEnsembleBase):
     def __init__(
         self,
@@ -141,6 +332,138 @@ class LayerEnsembleLinear(LayerEnsembleBase):
         )
 
 
+class StackedLayerEnsembleConvolution(StackedLayerEnsembleBase):
+    def __init__(
+        self,
+        num_ensemble: int,
+        in_channels: int,
+        out_channels: int,
+        kernel_size: int,
+        stride: Union[Tuple, int] = 1,
+        activation: Optional[nn.Module] = None,
+        use_batch_norm: bool = False,
+        batch_norm_eps: float = 1e-3,
+        batch_norm_momentum: float = 0.01,
+        bias=True,
+        **kwargs,
+    ) -> None:
+
+        super().__init__()
+
+        if use_batch_norm:
+            bias = False
+
+        members = [nn.Conv2d(
+            in_channels=in_channels,
+            out_channels=out_channels,
+            kernel_size=kernel_size,
+            stride=stride,
+            bias=bias,
+            **kwargs,
+        ) for _ in range(num_ensemble)]
+
+        if members[0].padding_mode != "zeros":
+            raise ValueError("Stacked layer ensembles support only zero padding")
+
+        super().build_stacked(
+            members,
+            nn.BatchNorm2d,
+            out_channels,
+            activation=activation,
+            use_batch_norm=use_batch_norm,
+            batch_norm_eps=batch_norm_eps,
+            batch_norm_momentum=batch_norm_momentum,
+        )
+
+        self.stride = members[0].stride
+        self.padding = members[0].padding
+        self.dilation = members[0].dilation
+        self.groups = members[0].groups
+
+    def forward_member(self, input, sample):
+        weight, bias = self.member_parameters(sample)
+        return nn.functional.conv2d(
+            input, weight, bias, self.stride, self.padding, self.dilation, self.groups
+        )
+
+    def forward_members(self, input, samples):
+
+        samples = torch.as_tensor(samples, device=self.weight.device)
+        count = len(samples)
+
+        # [samples * batch, C, H, W] -> [batch, samples * C, H, W] to run every member as a group
+        x = input.reshape(count, -1, *input.shape[1:])
+        batch = x.shape[1]
+        x = x.transpose(0, 1).reshape(batch, -1, *input.shape[2:])
+
+        weight, bias = self.member_parameters(samples)
+        weight = weight.reshape(-1, *weight.shape[2:])
+
+        if bias is not None:
+            bias = bias.reshape(-1)
+
+        result = nn.functional.conv2d(
+            x, weight, bias, self.stride, self.padding, self.dilation, self.groups * count
+        )
+        result = result.reshape(batch, count, -1, *result.shape[2:]).transpose(0, 1)
+        result = result.reshape(-1, *result.shape[2:])
+
+        return result
+
+
+class StackedLayerEnsembleLinear(StackedLayerEnsembleBase):
+    def __init__(
+        self,
+        num_ensemble: int,
+        in_features: int,
+        out_features: int,
+        activation: Optional[nn.Module] = None,
+        use_batch_norm: bool = False,
+        batch_norm_eps: float = 1e-3,
+        batch_norm_momentum: float = 0.01,
+        bias=True,
+        **kwargs,
+    ) -> None:
+
+        super().__init__()
+
+        if use_batch_norm:
+            bias = False
+
+        members = [nn.Linear(in_features, out_features, bias=bias, **kwargs) for _ in range(num_ensemble)]
+
+        super().build_stacked(
+            members,
+            nn.BatchNorm1d,
+            out_features,
+            activation=activation,
+            use_batch_norm=use_batch_norm,
+            batch_norm_eps=batch_norm_eps,
+            batch_norm_momentum=batch_norm_momentum,
+        )
+
+    def forward_member(self, input, sample):
+        weight, bias = self.member_parameters(sample)
+        return nn.functional.linear(input, weight, bias)
+
+    def forward_members(self, input, samples):
+
+        samples = torch.as_tensor(samples, device=self.weight.device)
+
+        x = input.reshape(len(samples), -1, input.shape[-1])
+        weight, bias = self.member_parameters(samples)
+        weight = weight.transpose(1, 2)
+
+        if bias is None:
+            result = torch.bmm(x, weight)
+        else:
+            result = torch.baddbmm(bias.unsqueeze(1), x, weight)
+
+        result = result.reshape(-1, *input.shape[1:-1], result.shape[-1])
+
+        return result
+
+
 class LayerEnsembleConvolutionTranspose(LayerEnsembleBase):
     def __init__(
         self,
@@ -183,9 +506,31 @@ class LayerEnsembleConvolutionTranspose(LayerEnsembleBase):
 
 
 class LayerEnsembleNetwork(Network):
-    def __init__(self, network_creator, prior_scale, average_results=False, **kwargs) -> None:
+
+    # one sample plan is drawn per forward call and shared by the whole batch
+    batch_samples = False
+
+    SAMPLE_PLANS = SamplePlanCache()
+
+    def __init__(
+        self,
+        network_creator,
+        prior_scale,
+        average_results=False,
+        vectorized=False,
+        prefix_sharing=False,
+        plan_seed: Optional[int] = None,
+        fused_prior=False,
+        **kwargs
+    ) -> None:
         super().__init__()
         self.prior_scale = prior_scale
+        self.fused_prior = fused_prior
+        self.vectorized = vectorized
+        self.prefix_sharing = prefix_sharing
+        self.plan_seed = plan_seed
+        self.evaluations = 0
+        self.saved_evaluations = 0
 
         empty = LayerEnsembleBase.collect()
         assert len(empty) == 0
@@ -199,18 +544,59 @@ class LayerEnsembleNetwork(Network):
 
         self.num_ensembles = [a.num_ensemble for a in self.network_collection]
         self.average_results = average_results
+        self.has_batch_norm = any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in self.network.modules())
         self.single_model_output = average_results
 
     def forward(self, x, samples=10):
-        sampled_models = self.sampler(samples)
-        result = self.batched(x, sampled_models)
+        plan = self.sample_plan(samples)
+        result = self.batched(x, plan)
 
         return result
 
+    def iterate_outputs(self, x, samples=10):
+
+        if self.single_model_output:
+            yield from super().iterate_outputs(x, samples)
+            return
+
+        plan = self.sample_plan(samples)
+
+        # the sequential path keeps only one sample output alive at a time
+        if self.vectorized or self.prefix_sharing:
+            yield from self.batched(x, plan)
+        else:
+            for sample in plan.samples:
+                yield from self.batched(x, sample[None])
+
+    def sample_plan(self, num_samples):
+
+        # a fixed seed makes every evaluation forward use the same cached plan,
+        # training always draws new samples
+        if self.plan_seed is None or self.training:
+            return SamplePlan(self.sampler(num_samples))
+
+        return LayerEnsembleNetwork.SAMPLE_PLANS.get(self.num_ensembles, num_samples, self.plan_seed)
+
     def batched(self, x, samples):
 
+        if not isinstance(samples, SamplePlan):
+            samples = SamplePlan(samples)
+
+        # batch norm in training mode would count every shared prefix only once in its batch statistics,
+        # so those passes run all samples without sharing
+        if self.prefix_sharing and (not self.training or not self.has_batch_norm):
+            return self.prefix_shared_batched(x, samples)
+
+        if self.vectorized or self.prefix_sharing:
+            return self.vectorized_batched(x, samples)
+
         def output_with_prior(network, prior, sample):
             self.select_sample(self.network_collection, sample)
+
+            if self.prior_scale > 0 and self.fused_prior:
+                result, prior_result = stacked_forward([network, prior], x)
+                return result + prior_result * self.prior_scale
+
             result = network(x)
             if self.prior_scale > 0:
                 self.select_sample(self.prior_collection, sample)
@@ -218,13 +604,67 @@ class LayerEnsembleNetwork(Network):
 
             return result
 
-        result = [output_with_prior(self.network, self.prior, sample) for sample in samples]
+        result = [output_with_prior(self.network, self.prior, sample) for sample in samples.samples]
 
         if self.average_results:
             result = torch.mean(torch.stack(result), dim=0)
 
         return result
 
+    def vectorized_batched(self, x, samples, select=None):
+
+        if select is None:
+            select = self.select_samples
+
+        count = len(samples)
+        inputs = x.unsqueeze(0).expand(count, *x.shape).reshape(-1, *x.shape[1:])
+
+        select(self.network_collection, samples, x.device)
+
+        if self.prior_scale > 0 and self.fused_prior:
+            # the prior runs through the network modules with its own
+            # parameters, so only the network layers need the samples
+            result, prior_result = stacked_forward([self.network, self.prior], inputs)
+            result = result + prior_result * self.prior_scale
+        else:
+            result = self.network(inputs)
+
+            if self.prior_scale > 0:
+                select(self.prior_collection, samples, x.device)
+                result = result + self.prior(inputs) * self.prior_scale
+
+        result = result.reshape(count, -1, *result.shape[1:])
+
+        if self.average_results:
+            return torch.mean(result, dim=0)
+
+        # separate tensors, as callers accumulate sample outputs in place
+        return [output.clone() for output in result]
+
+    def prefix_shared_batched(self, x, samples):
+
+        executors = []
+
+        def select(collection, samples, device):
+            executor = PrefixSharingExecutor(samples)
+            executor.select(collection)
+            executors.append(executor)
+
+        result = self.vectorized_batched(x, samples, select=select)
+
+        self.evaluations = sum(e.evaluations for e in executors)
+        self.saved_evaluations = sum(e.saved_evaluations for e in executors)
+
+        return result
+
+    def select_samples(self, collection, plan: SamplePlan, device=None):
+        assert plan.samples.shape[-1] == len(self.num_ensembles)
+
+        for i, layer in enumerate(collection):
+            assert plan.samples[:, i].max() < layer.num_ensemble
+
+            layer.sample = plan.layer_samples(i, device)
+
     def select_sample(self, collection, sample):
         assert len(sample) == len(self.num_ensembles)
 
@@ -234,41 +674,99 @@ class LayerEnsembleNetwork(Network):
 
             layer.sample = layer_sample
 
-    def sampler(self, num_samples=None):
+    def sampler(self, num_samples=None, rng=np.random):
 
-        def create_all_samples(i, num_ensembles, prefix):
-            result = []
-            for q in range(num_ensembles[i]):
-                value = (*prefix, q)
+        if num_samples is None:
+            return np.concatenate(list(iterate_layer_ensemble_samples(self.num_ensembles, chunk_size=1024)))
 
-                if i + 1 < len(num_ensembles):
-                    result += create_all_samples(i + 1, num_ensembles, value)
-                else:
-                    result.append(value)
+        return sample_layer_ensembles(self.num_ensembles, num_samples, rng)
 
-            return result
+    def iterate_samples(self, num_samples=None, chunk_size=1, rng=np.random):
+        return iterate_layer_ensemble_samples(self.num_ensembles, num_samples, chunk_size, rng)
 
-        all_samples = np.array(create_all_samples(0, self.num_ensembles, []))
 
-        if num_samples is None:
-            sorted_results = all_samples
-        else:
-            indices = np.random.choice(len(all_samples), num_samples, replace=False)
-            results = all_samples[indices]
+def total_layer_ensemble_samples(num_ensembles):
+    return int(np.prod(num_ensembles, dtype=object))
+
+
+def decode_layer_ensemble_samples(num_ensembles, indices):
+
+    # mixed-radix digits with the first layer as the most significant one
+    indices = np.array(indices, dtype=object)
+    result = np.zeros((len(indices), len(num_ensembles)), dtype=np.int64)
+
+    for i in reversed(range(len(num_ensembles))):
+        result[:, i] = (indices % num_ensembles[i]).astype(np.int64)
+        indices = indices // num_ensembles[i]
+
+    return result
+
+
+def sort_layer_ensemble_samples(samples):
+    lex_samples = [samples[:, samples.shape[-1] - 1 - i] for i in range(samples.shape[-1])]
+    return samples[np.lexsort(lex_samples)]
+
+
+def sample_layer_ensembles(num_ensembles, num_samples, rng=np.random):
+
+    total = total_layer_ensemble_samples(num_ensembles)
+
+    if num_samples > total:
+        raise ValueError(
+            "Cannot draw " + str(num_samples) + " unique samples out of " + str(total)
+        )
 
-            lex_results = [results[:, results.shape[-1] - 1 - i] for i in range(results.shape[-1])]
-            sorted_results = results[np.lexsort(lex_results)]
+    if total <= 2 * num_samples:
+        indices = rng.choice(total, num_samples, replace=False)
+        result = decode_layer_ensemble_samples(num_ensembles, indices)
+    else:
+        # at most half of the combinations are taken, so rejection of
+        # repeated rows needs less than two draws per sample on average
+        seen = set()
+        rows = []
 
-        return sorted_results
+        while len(rows) < num_samples:
+            row = tuple(rng.randint(0, n) for n in num_ensembles)
 
+            if row not in seen:
+                seen.add(row)
+                rows.append(row)
 
-def create_layer_ensemble_network(network_creator, num_ensemble=2, prior_scale=1, **kwargs):
+        result = np.array(rows, dtype=np.int64).reshape(num_samples, len(num_ensembles))
 
-    creator = network_creator(
-        specific_lens_layer(num_ensemble, LayerEnsembleConvolution),
-        specific_lens_layer(num_ensemble, LayerEnsembleLinear)
-    )
-    result = LayerEnsembleNetwork(creator, prior_scale, **kwargs)
+    return sort_layer_ensemble_samples(result)
+
+
+def iterate_layer_ensemble_samples(num_ensembles, num_samples=None, chunk_size=1, rng=np.random):
+
+    if num_samples is None:
+        rows = itertools.product(*[range(n) for n in num_ensembles])
+    else:
+        rows = iter(sample_layer_ensembles(num_ensembles, num_samples, rng))
+
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+
+        if len(chunk) == 0:
+            return
+
+        yield np.array(chunk, dtype=np.int64).reshape(len(chunk), len(num_ensembles))
+
+
+def create_layer_ensemble_network(network_creator, num_ensemble=2, prior_scale=1, stacked=False, prefix_sharing=False, **kwargs):
+
+    if stacked:
+        creator = network_creator(
+            specific_lens_layer(num_ensemble, StackedLayerEnsembleConvolution),
+            specific_lens_layer(num_ensemble, StackedLayerEnsembleLinear)
+        )
+    else:
+        creator = network_creator(
+            specific_lens_layer(num_ensemble, LayerEnsembleConvolution),
+            specific_lens_layer(num_ensemble, LayerEnsembleLinear)
+        )
+
+    result = LayerEnsembleNetwork(creator, prior_scale, vectorized=stacked, prefix_sharing=prefix_sharing, **kwargs)
 
     return result
 
@@ -277,6 +775,10 @@ def specific_lens_layer(num_ensemble, Layer: LayerEnsembleBase):
     return lambda *args, **kwargs: Layer(num_ensemble, *args, **kwargs)
 
 class SimpleLayerEnsembleNetwork(Network):
+
+    # every forward averages all member combinations
+    batch_samples = False
+
     def __init__(self, num_ensemble, optimized, **kwargs) -> None:
         super().__init__()
 
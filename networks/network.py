@@ -4,13 +4,137 @@ from torch import nn
 import os
 
 from torch.functional import Tensor
-from metrics import MeanStdMetric, AverageMetric
+from metrics import OnlineMeanStdMetric, AverageMetric
+from networks.checkpoint import CheckpointWriter, latest_checkpoint_path, write_checkpoint
+
+
+class StreamingOutputAggregator:
+    def __init__(self, track_variance=False) -> None:
+        self.track_variance = track_variance
+        self.count = 0
+        self.output = None
+        self.mean_std_metric = OnlineMeanStdMetric(inplace=True)
+        self.loss = None
+
+    def update(self, output, loss=None):
+
+        output = output.detach()
+        self.count += 1
+
+        if self.track_variance:
+            self.mean_std_metric.update(output)
+        elif self.output is None:
+            self.output = output.clone()
+        else:
+            self.output.add_(output)
+
+        if loss is not None:
+            loss = loss.detach()
+
+            if self.loss is None:
+                self.loss = loss.clone()
+            else:
+                self.loss.add_(loss)
+
+    def mean(self):
+
+        if self.track_variance:
+            return self.mean_std_metric.mean
+
+        return self.output / self.count
+
+    def variance(self):
+        return self.mean_std_metric.variance()
+
+    def average_loss(self):
+
+        if self.loss is None:
+            return None
+
+        return (self.loss / self.count).item()
+
+
+precisions = {
+    "fp32": None,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+class SampledNetwork(nn.Module):
+    def __init__(self, net, samples=1, output_module=None) -> None:
+        super().__init__()
+        self.net = net
+        self.samples = samples
+        self.output_module = output_module
+
+    def forward(self, x):
+
+        net = self.net
+
+        # all monte carlo samples go through one forward call, stacked as [samples, batch, ...],
+        # networks that share one sample across the batch are called once per sample
+        if not net.single_model_output:
+            outputs = torch.stack(list(net(x, samples=self.samples)))
+        elif net.batch_samples and self.samples > 1:
+            outputs = net(x.repeat(self.samples, *[1] * (x.dim() - 1)))
+            outputs = outputs.reshape(self.samples, x.shape[0], *outputs.shape[1:])
+        else:
+            outputs = torch.stack([net(x) for _ in range(self.samples)])
+
+        if self.output_module is not None:
+            outputs = self.output_module(outputs)
+
+        return outputs.mean(0)
 
 
 class Network(nn.Module):
+
+    # stochastic layers draw independent noise for every batch element,
+    # so samples can be taken by repeating the batch, networks that draw
+    # one sample for the whole batch set this to False
+    batch_samples = True
+
     def __init__(self) -> None:
         super().__init__()
         self.single_model_output = True
+        self.streaming_eval = False
+        self.track_eval_variance = False
+        self.eval_variance = None
+        self.replicated_samples = False
+        self.autocast_dtype = None
+        self.channels_last = False
+        self.grad_scaler = None
+        self.gradient_reducer = None
+        self.checkpoint_writer: Optional[CheckpointWriter] = None
+        self.best_result = None
+
+    def set_precision(self, precision="fp32", channels_last=False):
+
+        if precision not in precisions:
+            raise ValueError("precision '" + str(precision) + "' is unknown")
+
+        self.autocast_dtype = precisions[precision]
+        self.channels_last = channels_last
+
+        # the scaler only works on cuda, so set_precision is called after the network is moved to its device
+        on_cuda = any(parameter.is_cuda for parameter in self.parameters())
+        self.grad_scaler = torch.cuda.amp.GradScaler() if precision == "fp16" and on_cuda else None
+
+        if channels_last:
+            self.to(memory_format=torch.channels_last)  # type: ignore
+
+    def prepare_input(self, input):
+
+        if self.channels_last and input.dim() == 4:
+            return input.contiguous(memory_format=torch.channels_last)
+
+        return input
+
+    def autocast(self, input):
+        return torch.autocast(
+            input.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None
+        )
 
     def prepare_train(
         self,
@@ -37,38 +161,69 @@ class Network(nn.Module):
         ] = None,
         clip_grad: Optional[float] = None,
         samples=1,
+        sync_loss=True,
     ):
 
         average_loss = 0
         average_output = 0
 
-        if self.single_model_output:
-            for step in range(samples):
-                output = self(input)
-                loss = self.loss_func(output, target, self, self.batch) if self.loss_uses_network else self.loss_func(output, target)
-                average_loss += loss
-                average_output += output
+        input = self.prepare_input(input)
+
+        with self.autocast(input):
+            if self.single_model_output and self.replicated_samples and self.batch_samples and samples > 1:
+                # one forward over the tiled batch, every replica gets its own noise
+                outputs = self(input.repeat(samples, *[1] * (input.dim() - 1)))
+                outputs = outputs.reshape(samples, input.shape[0], *outputs.shape[1:])
+
+                for output in outputs:
+                    loss = self.loss_func(output, target, self, self.batch) if self.loss_uses_network else self.loss_func(output, target)
+                    average_loss += loss
+                    average_output += output
+            elif self.single_model_output:
+                for step in range(samples):
+                    output = self(input)
+                    loss = self.loss_func(output, target, self, self.batch) if self.loss_uses_network else self.loss_func(output, target)
+                    average_loss += loss
+                    average_output += output
+            else:
+                outputs = self(input, samples=samples)
+
+                for output in outputs:
+                    loss = self.loss_func(output, target, self, self.batch) if self.loss_uses_network else self.loss_func(output, target)
+                    average_loss += loss
+                    average_output += output
+
+            average_loss /= samples
+            average_output /= samples
+
+        if self.grad_scaler is None:
+            average_loss.backward()
+
+            if self.gradient_reducer is not None:
+                self.gradient_reducer(self)
+
+            if clip_grad is not None:
+                torch.nn.utils.clip_grad_norm_(self.parameters(), clip_grad)
+
+            self.optimizer.step()
         else:
-            outputs = self(input, samples=samples)
+            # fp16 gradients underflow without loss scaling, bf16 does not need it
+            self.grad_scaler.scale(average_loss).backward()
 
-            for output in outputs:
-                loss = self.loss_func(output, target, self, self.batch) if self.loss_uses_network else self.loss_func(output, target)
-                average_loss += loss
-                average_output += output
-        
-        average_loss /= samples
-        average_output /= samples
+            if self.gradient_reducer is not None:
+                self.gradient_reducer(self)
 
-        average_loss.backward()
+            if clip_grad is not None:
+                self.grad_scaler.unscale_(self.optimizer)
+                torch.nn.utils.clip_grad_norm_(self.parameters(), clip_grad)
 
-        if clip_grad is not None:
-            torch.nn.utils.clip_grad_norm_(self.parameters(), clip_grad)
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
 
-        self.optimizer.step()
         self.optimizer.zero_grad()
 
         loss_dict = {
-            "loss": average_loss.item(),
+            "loss": average_loss.item() if sync_loss else average_loss.detach(),
         }
 
         if correct_count is None:
@@ -91,7 +246,7 @@ class Network(nn.Module):
     ):
 
         mean_losses: List[Tensor] = []
-        mean_std_outputs_metric = MeanStdMetric()
+        mean_std_outputs_metric = OnlineMeanStdMetric()
         mean_uncertainty_metric = AverageMetric()
 
         correctness = None
@@ -130,6 +285,9 @@ class Network(nn.Module):
 
         loss.backward()
 
+        if self.gradient_reducer is not None:
+            self.gradient_reducer(self)
+
         if clip_grad is not None:
             torch.nn.utils.clip_grad_norm_(self.parameters(), clip_grad)
 
@@ -147,6 +305,50 @@ class Network(nn.Module):
         else:
             return loss_dict, correctness
 
+    def iterate_outputs(self, input, samples=1):
+
+        if self.single_model_output:
+            for step in range(samples):
+                yield self(input)
+        else:
+            yield from self(input, samples=samples)
+
+    def streaming_eval_step(
+        self,
+        input,
+        target,
+        correct_count: Optional[
+            Callable[[torch.Tensor, torch.Tensor], int]
+        ] = None,
+        samples=1,
+    ):
+
+        aggregator = StreamingOutputAggregator(self.track_eval_variance)
+        has_loss = hasattr(self, "loss_func")
+
+        with torch.no_grad():
+            for output in self.iterate_outputs(input, samples):
+                loss = (
+                    (self.loss_func(output, target, self, self.batch) if self.loss_uses_network else self.loss_func(output, target))
+                    if has_loss
+                    else None
+                )
+                aggregator.update(output, loss)
+
+        average_output = aggregator.mean()
+
+        if self.track_eval_variance:
+            self.eval_variance = aggregator.variance()
+
+        loss_dict = {
+            "loss": aggregator.average_loss(),
+        }
+
+        if correct_count is None:
+            return loss_dict
+        else:
+            return loss_dict, correct_count(average_output, target)
+
     def eval_step(
         self,
         input,
@@ -157,6 +359,24 @@ class Network(nn.Module):
         samples=1,
     ):
 
+        input = self.prepare_input(input)
+
+        with self.autocast(input):
+            if self.streaming_eval:
+                return self.streaming_eval_step(input, target, correct_count, samples)
+
+            return self.sampled_eval_step(input, target, correct_count, samples)
+
+    def sampled_eval_step(
+        self,
+        input,
+        target,
+        correct_count: Optional[
+            Callable[[torch.Tensor, torch.Tensor], int]
+        ] = None,
+        samples=1,
+    ):
+
         average_output = None
         average_loss = None
 
@@ -211,26 +431,58 @@ class Network(nn.Module):
         else:
             return loss_dict, correct_count(average_output, target)
 
-    def save(self, save_path):
+    def save(self, save_path, step=None, training_state=None):
+
+        files = {
+            "model.pth": self.state_dict(),
+            "optimizer.pth": self.optimizer.state_dict(),
+        }
+
+        if training_state is not None:
+            files["training_state.pth"] = {
+                **training_state,
+                "grad_scaler": None if self.grad_scaler is None else self.grad_scaler.state_dict(),
+            }
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(save_path, files, step)
+            return
 
-        if not os.path.exists(save_path):
-            os.mkdir(save_path)
+        write_checkpoint(save_path, files, step)
 
-        torch.save(self.state_dict(), save_path + "/model.pth")
-        torch.save(self.optimizer.state_dict(), save_path + "/optimizer.pth")
+    def after_save(self, function):
+
+        # runs once every checkpoint queued so far has been written
+        if self.checkpoint_writer is None:
+            function()
+        else:
+            self.checkpoint_writer.submit(function)
 
     def load(self, load_path, device=None):
         self.load_state_dict(
             torch.load(load_path + "/model.pth", map_location=device)
         )
 
+    def load_training(self, load_path, training_state, device=None):
+
+        # model, optimizer and training state always come from the same step
+        load_path = latest_checkpoint_path(load_path)
+
+        self.load(load_path, device)
+        self.optimizer.load_state_dict(
+            torch.load(load_path + "/optimizer.pth", map_location=device)
+        )
+
+        if self.grad_scaler is not None and training_state["grad_scaler"] is not None:
+            self.grad_scaler.load_state_dict(training_state["grad_scaler"])
+
     def uncertainty(self, method="monte-carlo", params=None):
 
         if method == "monte-carlo":
             if "repeats" not in params:
                 params["repeats"] = 10
 
-            mean_std_metric = MeanStdMetric()
+            mean_std_metric = OnlineMeanStdMetric()
 
             for i in range(params["repeats"]):
                 mean_std_metric.update(
@@ -0,0 +1,236 @@
+from typing import Dict, List, Tuple
+import torch
+from torch import nn
+from torch.func import functional_call, vmap
+
+
+def stack_module_state(modules: List[nn.Module]) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+
+    # unlike torch.func.stack_module_state, stacked parameters stay
+    # connected to the original ones, so gradients reach every module
+    named_parameters = [dict(m.named_parameters()) for m in modules]
+    named_buffers = [dict(m.named_buffers()) for m in modules]
+
+    params = {
+        name: torch.stack([p[name] for p in named_parameters]) for name in named_parameters[0].keys()
+    }
+    buffers = {
+        name: torch.stack([b[name] for b in named_buffers]) for name in named_buffers[0].keys()
+    }
+
+    return params, buffers
+
+
+def unstack_buffers(modules: List[nn.Module], buffers: Dict[str, torch.Tensor]):
+
+    with torch.no_grad():
+        for i, module in enumerate(modules):
+            for name, buffer in module.named_buffers():
+                buffer.copy_(buffers[name][i])
+
+
+def unstack_parameters(modules: List[nn.Module], params: Dict[str, torch.Tensor]):
+
+    with torch.no_grad():
+        for i, module in enumerate(modules):
+            for name, p in module.named_parameters():
+                p.copy_(params[name][i])
+
+
+def stacked_forward(modules: List[nn.Module], *inputs, base=None, state=None):
+
+    if base is None:
+        base = modules[0]
+
+    if state is None:
+        state = stack_module_state(modules)
+
+    params, buffers = state
+
+    def call(params, buffers, *inputs):
+        return functional_call(base, (params, buffers), inputs)
+
+    result = vmap(
+        call, in_dims=(0, 0, *[None] * len(inputs)), randomness="different"
+    )(params, buffers, *inputs)
+
+    if base.training:
+        # batch norm updates the running statistics of the stacked copies
+        unstack_buffers(modules, buffers)
+
+    return result
+
+
+def is_homogeneous(modules: List[nn.Module]):
+
+    shapes = [
+        [(name, p.shape) for name, p in [*m.named_parameters(), *m.named_buffers()]] for m in modules
+    ]
+
+    return all(s == shapes[0] for s in shapes[1:])
+
+
+def has_cumulative_batch_norm(modules: List[nn.Module]):
+
+    # momentum=None batch norm reads num_batches_tracked as a python float,
+    # which cannot be done for a stacked buffer
+    return any(
+        isinstance(a, nn.modules.batchnorm._BatchNorm) and a.momentum is None
+        for m in modules for a in m.modules()
+    )
+
+
+class StackedModules:
+    def __init__(self, modules: List[nn.Module]) -> None:
+        self.modules = modules
+        self.homogeneous = is_homogeneous(modules)
+        self.cumulative_batch_norm = has_cumulative_batch_norm(modules)
+        self.state = None
+        self.versions = None
+
+    def can_vectorize(self):
+        return self.homogeneous and not (self.modules[0].training and self.cumulative_batch_norm)
+
+    def stacked_state(self):
+
+        if torch.is_grad_enabled() or self.modules[0].training:
+            self.state = None
+            return stack_module_state(self.modules)
+
+        # inference reuses the stacked copies until any parameter or buffer changes
+        versions = [
+            (t._version, t.data_ptr()) for m in self.modules for t in [*m.parameters(), *m.buffers()]
+        ]
+
+        if self.state is None or versions != self.versions:
+            self.state = stack_module_state(self.modules)
+            self.versions = versions
+
+        return self.state
+
+    def __call__(self, *inputs):
+
+        if not self.can_vectorize():
+            return torch.stack([m(*inputs) for m in self.modules])
+
+        return stacked_forward(self.modules, *inputs, state=self.stacked_state())
+
+
+class StackedOptimizer:
+
+    # one Adam or SGD update for parameters stacked as [trials, ...], where every trial
+    # keeps the hyperparameters of its own optimizer
+    def __init__(self, params: Dict[str, torch.Tensor], optimizers: List[torch.optim.Optimizer]) -> None:
+        self.params = params
+        self.optimizers = optimizers
+        self.state: Dict[str, Dict] = {name: {} for name in params.keys()}
+
+        groups = [optimizer.param_groups[0] for optimizer in optimizers]
+        device = next(iter(params.values())).device
+
+        def hyperparameter(get):
+            return torch.tensor([float(get(group)) for group in groups], device=device)
+
+        if all(isinstance(optimizer, torch.optim.Adam) for optimizer in optimizers):
+            if any(group["amsgrad"] or group["maximize"] for group in groups):
+                raise ValueError("Stacked Adam supports neither amsgrad nor maximize")
+
+            self.adam = True
+            self.hyperparameters = {
+                "lr": hyperparameter(lambda group: group["lr"]),
+                "beta1": hyperparameter(lambda group: group["betas"][0]),
+                "beta2": hyperparameter(lambda group: group["betas"][1]),
+                "eps": hyperparameter(lambda group: group["eps"]),
+                "weight_decay": hyperparameter(lambda group: group["weight_decay"]),
+            }
+        elif all(type(optimizer) is torch.optim.SGD for optimizer in optimizers):
+            if any(group["nesterov"] or group["maximize"] for group in groups):
+                raise ValueError("Stacked SGD supports neither nesterov nor maximize")
+
+            self.adam = False
+            self.hyperparameters = {
+                "lr": hyperparameter(lambda group: group["lr"]),
+                "momentum": hyperparameter(lambda group: group["momentum"]),
+                "dampening": hyperparameter(lambda group: group["dampening"]),
+                "weight_decay": hyperparameter(lambda group: group["weight_decay"]),
+            }
+        else:
+            raise ValueError("Stacked optimizers need all trials to use Adam or all to use SGD")
+
+        self.weight_decay = bool((self.hyperparameters["weight_decay"] != 0).any())
+
+        # hyperparameters broadcast over the parameter dimensions, one view per parameter rank
+        self.shaped: Dict[int, Dict[str, torch.Tensor]] = {}
+
+        for p in params.values():
+            if p.dim() not in self.shaped:
+                shape = (-1,) + (1,) * (p.dim() - 1)
+                self.shaped[p.dim()] = {key: value.view(shape) for key, value in self.hyperparameters.items()}
+
+    def step(self):
+
+        with torch.no_grad():
+            for name, p in self.params.items():
+
+                if p.grad is None:
+                    continue
+
+                h = self.shaped[p.dim()]
+                state = self.state[name]
+                grad = p.grad
+
+                if self.weight_decay:
+                    grad = grad.addcmul(p, h["weight_decay"])
+
+                if self.adam:
+                    if len(state) == 0:
+                        state["step"] = 0
+                        state["exp_avg"] = torch.zeros_like(p)
+                        state["exp_avg_sq"] = torch.zeros_like(p)
+
+                    state["step"] += 1
+                    state["exp_avg"].lerp_(grad, 1 - h["beta1"])
+                    state["exp_avg_sq"].mul_(h["beta2"]).addcmul_(grad, grad * (1 - h["beta2"]))
+
+                    step_size = h["lr"] / (1 - h["beta1"] ** state["step"])
+                    bias_correction2 = (1 - h["beta2"] ** state["step"]).sqrt()
+
+                    denominator = state["exp_avg_sq"].sqrt().div_(bias_correction2).add_(h["eps"]).div_(step_size)
+                    p.addcdiv_(state["exp_avg"], denominator, value=-1)
+                else:
+                    if "momentum_buffer" not in state:
+                        state["momentum_buffer"] = grad.clone()
+                    else:
+                        state["momentum_buffer"].mul_(h["momentum"]).add_(grad * (1 - h["dampening"]))
+
+                    # trials without momentum use the plain gradient, like torch SGD
+                    direction = torch.where(h["momentum"] == 0, grad, state["momentum_buffer"])
+
+                    p.addcmul_(direction, h["lr"], value=-1)
+
+    def zero_grad(self):
+        for p in self.params.values():
+            p.grad = None
+
+    def unstack_state(self, modules: List[nn.Module]):
+
+        # per trial optimizer states in the format of the original optimizers, so they can be saved and loaded
+        for i, (module, optimizer) in enumerate(zip(modules, self.optimizers)):
+            for name, p in module.named_parameters():
+                state = self.state[name]
+
+                if len(state) == 0:
+                    continue
+
+                if self.adam:
+                    optimizer.state[p] = {
+                        "step": torch.tensor(float(state["step"])),
+                        "exp_avg": state["exp_avg"][i].clone(),
+                        "exp_avg_sq": state["exp_avg_sq"][i].clone(),
+                    }
+                else:
+                    optimizer.state[p] = {
+                        "momentum_buffer": (
+                            state["momentum_buffer"][i].clone() if float(self.hyperparameters["momentum"][i]) != 0 else None
+                        ),
+                    }
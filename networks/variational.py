@@ -114,6 +114,20 @@ class VariationalBase(nn.Module):
                 else:
                     raise ValueError("Unknown activation target: " + target)
 
+    def project(self, x):
+
+        means = self.means(x)
+
+        if self.stds:
+            stds = self.stds(x)
+        else:
+            stds = 0
+
+        return means, stds
+
+    def sample(self, means, stds):
+        return means + stds * torch.normal(0, torch.ones_like(means))
+
     def forward(self, input):
 
         if isinstance(input, tuple):
@@ -122,12 +136,7 @@ class VariationalBase(nn.Module):
             x = input
             nstd_x = x
 
-        means = self.means(x)
-
-        if self.stds:
-            stds = self.stds(x)
-        else:
-            stds = 0
+        means, stds = self.project(x)
 
         if self.global_std_mode == "replace":
             stds = VariationalBase.GLOBAL_STD
@@ -159,7 +168,7 @@ class VariationalBase(nn.Module):
         # else:
         #     result = torch.distributions.Normal(means, stds).rsample()
         # result = torch.distributions.Normal(means, stds.abs() + 1e-40).rsample()
-        result = means + stds * torch.normal(0, torch.ones_like(means))
+        result = self.sample(means, stds)
 
         if self.end_batch_norm is not None:
             result = self.end_batch_norm(result)
@@ -383,3 +392,97 @@ class VariationalConvolutionTranspose(VariationalBase):
             batch_norm_momentum=batch_norm_momentum,
             global_std_mode=global_std_mode,
         )
+
+
+def innermost_layer(module: nn.Module):
+
+    # build wraps the projection into sequentials for batch norm and activation,
+    # the projection itself is always the first element of the innermost one
+    parent, path = None, []
+
+    while isinstance(module, nn.Sequential):
+        parent = module
+        path.append("0")
+        module = module[0]
+
+    return module, parent, ".".join(path)
+
+
+class FusedVariationalBase(VariationalBase):
+    def fuse(self, split_dim: int) -> None:
+
+        self.split_dim = split_dim
+        self.paths = {}
+        layers = []
+
+        for name in ["means", "stds"]:
+            branch = getattr(self, name)
+
+            if branch is None:
+                continue
+
+            layer, parent, path = innermost_layer(branch)
+
+            if parent is None:
+                setattr(self, name, nn.Identity())
+            else:
+                parent[0] = nn.Identity()
+
+            self.paths[name] = name + ("." + path if path != "" else "") + "."
+            layers.append(layer)
+
+        # mean and std outputs are concatenated along the channels of one layer
+        self.split_size = layers[0].weight.shape[0]
+        self.projection = layers[0]
+
+        with torch.no_grad():
+            self.projection.weight = nn.Parameter(torch.cat([layer.weight for layer in layers]))
+
+            if self.projection.bias is not None:
+                self.projection.bias = nn.Parameter(torch.cat([layer.bias for layer in layers]))
+
+        if isinstance(self.projection, nn.Linear):
+            self.projection.out_features = self.projection.weight.shape[0]
+        else:
+            self.projection.out_channels = self.projection.weight.shape[0]
+
+    def project(self, x):
+
+        projected = self.projection(x)
+
+        if self.stds is None:
+            return self.means(projected), 0
+
+        means, stds = projected.split(self.split_size, self.split_dim)
+
+        return self.means(means), self.stds(stds)
+
+    def sample(self, means, stds):
+
+        if isinstance(stds, (int, float)):
+            return means + stds * torch.randn_like(means)
+
+        return torch.addcmul(means, stds, torch.randn_like(means))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+
+        # checkpoints of the unfused layers keep separate mean and std weights
+        for parameter in ["weight", "bias"]:
+            keys = [prefix + path + parameter for path in self.paths.values()]
+
+            if all(key in state_dict for key in keys):
+                state_dict[prefix + "projection." + parameter] = torch.cat([state_dict.pop(key) for key in keys])
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class FusedVariationalConvolution(FusedVariationalBase, VariationalConvolution):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.fuse(1)
+
+
+class FusedVariationalLinear(FusedVariationalBase, VariationalLinear):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.fuse(-1)
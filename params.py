@@ -25,6 +25,8 @@ from networks.architectures.mnist_mini_base import createMnistMiniBase
 from networks.architectures.mnist_auto_encoder_base import createMnistAutoEncoderBase
 from networks.architectures.vgg import createVGG
 from networks.variational import (
+    FusedVariationalConvolution,
+    FusedVariationalLinear,
     VariationalConvolution,
     VariationalLinear,
 )
@@ -120,6 +122,12 @@ attacked_dataset_params = {
     },
 }
 
+
+def noise_transforms(noise):
+    # batched perturbations are applied after loading, so no per item transform is needed
+    return [] if noise is None else [transforms.Lambda(noise)]
+
+
 perturbed_dataset_params = {
 
     "mnist": lambda noise: {
@@ -131,7 +139,7 @@ perturbed_dataset_params = {
             "all": transforms.Compose(
                 [
                     transforms.ToTensor(),
-                    transforms.Lambda(noise),
+                    *noise_transforms(noise),
                     transforms.Normalize((0.1307,), (0.3081,)),
                 ]
             )
@@ -146,7 +154,7 @@ perturbed_dataset_params = {
             "all": transforms.Compose(
                 [
                     transforms.ToTensor(),
-                    transforms.Lambda(noise),
+                    *noise_transforms(noise),
                     transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
                 ]
             )
@@ -161,7 +169,7 @@ perturbed_dataset_params = {
             "all": transforms.Compose(
                 [
                     transforms.ToTensor(),
-                    transforms.Lambda(noise),
+                    *noise_transforms(noise),
                     transforms.Normalize(
                         [x / 255 for x in [125.3, 123.0, 113.9]],
                         [x / 255 for x in [63.0, 62.1, 66.7]],
@@ -181,7 +189,7 @@ perturbed_dataset_params = {
                     transforms.RandomHorizontalFlip(),
                     transforms.RandomCrop(32, padding=4),
                     transforms.ToTensor(),
-                    transforms.Lambda(noise),
+                    *noise_transforms(noise),
                     transforms.Normalize(
                         [x / 255 for x in [125.3, 123.0, 113.9]],
                         [x / 255 for x in [63.0, 62.1, 66.7]],
@@ -191,7 +199,7 @@ perturbed_dataset_params = {
             "test": transforms.Compose(
                 [
                     transforms.ToTensor(),
-                    transforms.Lambda(noise),
+                    *noise_transforms(noise),
                     transforms.Normalize(
                         [x / 255 for x in [125.3, 123.0, 113.9]],
                         [x / 255 for x in [63.0, 62.1, 66.7]],
@@ -295,6 +303,8 @@ def create_network(network_name, network_type):
     def model_generator(network_creator, network_type):
         if network_type == "vnn":
             return network_creator(VariationalConvolution, VariationalLinear)
+        if network_type == "vnn_fused":
+            return network_creator(FusedVariationalConvolution, FusedVariationalLinear)
         if network_type == "classic":
             return network_creator(ClassicConvolution, ClassicLinear)
         elif network_type == "dropout":
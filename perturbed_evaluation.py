@@ -6,6 +6,220 @@ from params import (
     SEED,
     perturbed_dataset_params,
 )
+from dataset_cache import CachedDataLoader
+
+
+def sample_random(indices, shape, random=torch.rand):
+
+    # every sample draws from its own generator, so the perturbation of an
+    # image does not depend on the batch size or the order of the batches
+    return torch.stack([
+        random(shape, generator=torch.Generator().manual_seed(SEED + int(index))) for index in indices
+    ])
+
+
+def gaussian_perturbation(mean, std):
+
+    def perturb(images, indices):
+        noise = sample_random(indices, images.shape[1:], torch.randn)
+        return images.add_(noise.mul_(std).add_(mean))
+
+    return perturb
+
+
+def uniform_perturbation(mean, std):
+
+    def perturb(images, indices):
+        noise = sample_random(indices, images.shape[1:])
+        return images.add_(noise.mul_(std).add_(mean))
+
+    return perturb
+
+
+def bar_occlusion_perturbation(bounds, occlusion_value):
+
+    def perturb(images, indices):
+
+        width, height = images.shape[2:4]
+        random = sample_random(indices, (4,))
+
+        w = bounds[0] + (random[:, 0] * (bounds[1] - bounds[0] + 1)).long()
+        h = bounds[0] + (random[:, 1] * (bounds[1] - bounds[0] + 1)).long()
+        x = (random[:, 2] * (width - w + 1)).long()
+        y = (random[:, 3] * (height - h + 1)).long()
+
+        rows = torch.arange(width).reshape(1, -1)
+        columns = torch.arange(height).reshape(1, -1)
+
+        row_mask = (rows >= x[:, None]) & (rows < (x + w)[:, None])
+        column_mask = (columns >= y[:, None]) & (columns < (y + h)[:, None])
+        mask = row_mask[:, None, :, None] & column_mask[:, None, None, :]
+
+        return images.masked_fill_(mask, occlusion_value)
+
+    return perturb
+
+
+def random_occlusion_perturbation(occlusion_chance, occlusion_value):
+
+    def perturb(images, indices):
+        mask = sample_random(indices, images.shape[1:]) <= occlusion_chance
+        return images.masked_fill_(mask, occlusion_value)
+
+    return perturb
+
+
+def swap_perturbation(swaps):
+
+    def perturb(images, indices):
+
+        batch = images.shape[0]
+        pixels = images.shape[2] * images.shape[3]
+        positions = (sample_random(indices, (swaps, 2)) * pixels).long()
+
+        # swaps are composed into one permutation per image, which is then gathered at once
+        permutation = torch.arange(pixels).repeat(batch, 1)
+        all_images = torch.arange(batch)
+
+        for i in range(swaps):
+            first = positions[:, i, 0]
+            second = positions[:, i, 1]
+            permutation[all_images, first], permutation[all_images, second] = (
+                permutation[all_images, second], permutation[all_images, first],
+            )
+
+        flat = images.flatten(2)
+        result = flat.gather(2, permutation[:, None, :].expand(-1, flat.shape[1], -1))
+
+        return result.reshape(images.shape)
+
+    return perturb
+
+
+def gaussian_levels(mean=0, std_start=0.1, std_end=1, count=10, **kwargs):
+
+    step = std_end / count
+
+    return [
+        ({"std": round(float(std), 2)}, gaussian_perturbation(mean, std))
+        for std in np.arange(std_start, std_end + step, step)
+    ]
+
+
+def uniform_levels(mean=0, std_start=0.1, std_end=2, count=10, **kwargs):
+
+    step = std_end / count
+
+    return [
+        ({"std": round(float(std), 2)}, uniform_perturbation(mean, std))
+        for std in np.arange(std_start, std_end + step, step)
+    ]
+
+
+def bar_occluded_levels(
+    size_bounds: List[Tuple[int, int]] = [(5, 10), (10, 15), (15, 20)], occlusion_value: float = 0.5, **kwargs
+):
+    return [
+        ({"bounds": list(bounds)}, bar_occlusion_perturbation(bounds, occlusion_value))
+        for bounds in size_bounds
+    ]
+
+
+def randomly_occluded_levels(
+    occlusion_chances: List[float] = [0.1, 0.2, 0.3, 0.4, 0.5], occlusion_value: float = 0.5, **kwargs
+):
+    return [
+        ({"occlusion_chance": occlusion_chance}, random_occlusion_perturbation(occlusion_chance, occlusion_value))
+        for occlusion_chance in occlusion_chances
+    ]
+
+
+def randomly_swapped_levels(swap_counts: List[int] = [200, 400, 500, 600, 800], **kwargs):
+    return [
+        ({"swaps": swaps}, swap_perturbation(swaps))
+        for swaps in swap_counts
+    ]
+
+
+perturbation_levels = {
+    "gaussian": gaussian_levels,
+    "uniform": uniform_levels,
+    "bar_occluded": bar_occluded_levels,
+    "randomly_occluded": randomly_occluded_levels,
+    "randomly_swapped": randomly_swapped_levels,
+}
+
+
+def create_sweep_levels(perturbation_types, **kwargs):
+
+    levels = []
+
+    for perturbation_type in perturbation_types:
+        for level, perturbation in perturbation_levels[perturbation_type](**kwargs):
+            levels.append(({"type": perturbation_type, **level}, perturbation))
+
+    return levels
+
+
+def sweep_perturbation(perturbations):
+
+    # every clean batch is expanded into a level-major batch [levels * batch, ...]
+    def perturb(images, indices):
+        return torch.cat([perturbation(images.clone(), indices) for perturbation in perturbations])
+
+    return perturb
+
+
+def evaluate_sweep(net, dataset, device, batch, samples, levels, eval_step=None, levels_per_forward=None):
+
+    if eval_step is None:
+        eval_step = net.eval_step
+
+    if levels_per_forward is None:
+        levels_per_forward = len(levels)
+
+    net.eval()
+
+    loader = CachedDataLoader(dataset, batch, shuffle=False)
+    correct = torch.zeros(len(levels), dtype=torch.long, device=device)
+
+    # a forward pass holds levels_per_forward copies of the batch, the perturbations only
+    # depend on the sample index, so every chunk of levels sees the same noise
+    for start in range(0, len(levels), levels_per_forward):
+
+        chunk = levels[start:start + levels_per_forward]
+        dataset.perturbation = sweep_perturbation([perturbation for _, perturbation in chunk])
+        total = 0
+
+        def level_correct_count(output, target):
+            labels = output.data.max(1)[1]
+            return labels.eq(target.data).reshape(len(chunk), -1).sum(1)
+
+        for i, (data, target) in enumerate(loader):
+
+            data = data.to(device)
+            target = target.to(device)
+
+            _, current_correct = eval_step(  # type: ignore
+                data, target.repeat(len(chunk)), correct_count=level_correct_count, samples=samples
+            )
+
+            correct[start:start + len(chunk)] += current_correct
+            total += len(target)
+
+            print(
+                "sweep l[" + str(start + len(chunk)) + "/" + str(len(levels)) + "]"
+                + " s[" + str(i + 1) + "/" + str(len(loader)) + "]",
+                end="\r",
+            )
+
+    print()
+
+    dataset.perturbation = None
+
+    return [
+        {**level, "accuracy": value / total} for (level, _), value in zip(levels, correct.tolist())
+    ]
 
 
 def evaluate_gaussian(
@@ -15,6 +229,7 @@ def evaluate_gaussian(
     std_start=0.1,
     std_end=1,
     count=10,
+    batched=False,
     **kwargs
 ):
 
@@ -28,9 +243,14 @@ def evaluate_gaussian(
             result = x + torch.normal(torch.ones(x.shape) * mean, std,)
             return result
 
-        result, fps = evaluate(
-            perturbed_dataset_params[dataset_name](gaussian_noise)
-        )
+        if batched:
+            result, fps = evaluate(
+                perturbed_dataset_params[dataset_name](None), gaussian_perturbation(mean, std)
+            )
+        else:
+            result, fps = evaluate(
+                perturbed_dataset_params[dataset_name](gaussian_noise)
+            )
         results.append(
             "std: " + str(round(std, 2)) + " result: " + str(result)
         )
@@ -45,6 +265,7 @@ def evaluate_uniform(
     std_start=0.1,
     std_end=2,
     count=10,
+    batched=False,
     **kwargs
 ):
 
@@ -58,9 +279,14 @@ def evaluate_uniform(
             result = x + mean + std * torch.rand_like(torch.ones(x.shape))
             return result
 
-        result, fps = evaluate(
-            perturbed_dataset_params[dataset_name](gaussian_noise)
-        )
+        if batched:
+            result, fps = evaluate(
+                perturbed_dataset_params[dataset_name](None), uniform_perturbation(mean, std)
+            )
+        else:
+            result, fps = evaluate(
+                perturbed_dataset_params[dataset_name](gaussian_noise)
+            )
         results.append(
             "std: " + str(round(std, 2)) + " result: " + str(result)
         )
@@ -73,6 +299,7 @@ def evaluate_bar_occluded(
     dataset_name,
     size_bounds: List[Tuple[int, int]] = [(5, 10), (10, 15), (15, 20)],
     occlusion_value: float = 0.5,
+    batched=False,
     **kwargs
 ):
 
@@ -106,7 +333,12 @@ def evaluate_bar_occluded(
 
             return result
 
-        result, fps = evaluate(perturbed_dataset_params[dataset_name](occluded))
+        if batched:
+            result, fps = evaluate(
+                perturbed_dataset_params[dataset_name](None), bar_occlusion_perturbation(bounds, occlusion_value)
+            )
+        else:
+            result, fps = evaluate(perturbed_dataset_params[dataset_name](occluded))
 
         results.append("bounds: " + str(bounds) + " result: " + str(result))
 
@@ -118,6 +350,7 @@ def evaluate_randomly_occluded(
     dataset_name,
     occlusion_chances: List[float] = [0.1, 0.2, 0.3, 0.4, 0.5],
     occlusion_value: float = 0.5,
+    batched=False,
     **kwargs
 ):
 
@@ -143,7 +376,13 @@ def evaluate_randomly_occluded(
 
             return result
 
-        result, fps = evaluate(perturbed_dataset_params[dataset_name](occluded))
+        if batched:
+            result, fps = evaluate(
+                perturbed_dataset_params[dataset_name](None),
+                random_occlusion_perturbation(occlusion_chance, occlusion_value),
+            )
+        else:
+            result, fps = evaluate(perturbed_dataset_params[dataset_name](occluded))
 
         results.append(
             "occlusion_chanse: "
@@ -159,6 +398,7 @@ def evaluate_randomly_swapped(
     evaluate,
     dataset_name,
     swap_counts: List[int] = [200, 400, 500, 600, 800],
+    batched=False,
     **kwargs
 ):
 
@@ -194,7 +434,10 @@ def evaluate_randomly_swapped(
 
             return result
 
-        result, fps = evaluate(perturbed_dataset_params[dataset_name](swapped))
+        if batched:
+            result, fps = evaluate(perturbed_dataset_params[dataset_name](None), swap_perturbation(swaps))
+        else:
+            result, fps = evaluate(perturbed_dataset_params[dataset_name](swapped))
 
         results.append(
             "swaps: "
@@ -0,0 +1,333 @@
+import os
+import time
+from typing import Optional
+import fire
+import torch
+from torch.func import functional_call, vmap
+from tensorboardX import SummaryWriter
+
+from dataset_cache import create_data_loader, set_loader_epoch
+from main import (
+    correct_count,
+    create_model_description,
+    create_model_directories,
+    create_model_path,
+    create_train_validation_test,
+    process_activation_kwargs,
+    process_loss_kwargs,
+    process_optimizer_kwargs,
+    record_validation,
+    run_evaluation,
+)
+from metrics import AverageMetric, ExponentialMovingAverageMetric, WindowedAverageMetric
+from networks.checkpoint import get_rng_states
+from networks.network import Network
+from networks.stacked import (
+    StackedOptimizer,
+    has_cumulative_batch_norm,
+    is_homogeneous,
+    stack_module_state,
+    unstack_buffers,
+    unstack_parameters,
+)
+from networks.variational import VariationalBase
+from params import create_network, dataset_params, loss_functions, loss_functions_that_use_network, optimizers
+from summary import BatchedSummaryWriter
+from sweep_runtime import SweepRuntime
+
+
+def is_stackable_key(key):
+
+    # vmap reads every non-parameter attribute from the first copy,
+    # so trials may only differ in their initialization and optimizer
+    return key in ["model_suffix", "seed"] or key.startswith("optimizer_")
+
+
+def create_trial_network(network_name, network_type, optimizer, loss, batch, seed, kwargs):
+
+    if seed is not None:
+        torch.manual_seed(seed)
+
+    if "activation" in kwargs:
+        kwargs = process_activation_kwargs(kwargs)
+
+    kwargs, current_optimizer_params = process_optimizer_kwargs(optimizer, kwargs)
+    kwargs, current_loss_params = process_loss_kwargs(loss, kwargs)
+
+    net: Network = create_network(network_name, network_type)(**kwargs)
+
+    if not net.single_model_output:
+        raise ValueError("Network type '" + network_type + "' can not be trained as stacked trials")
+
+    net.prepare_train(
+        optimizer=optimizers[optimizer],
+        optimizer_params=current_optimizer_params,
+        loss_func=loss_functions[loss](**current_loss_params),
+        loss_uses_network=False,
+        batch=batch,
+    )
+
+    return net
+
+
+class StackedTrials:
+    def __init__(self, nets, samples=1) -> None:
+
+        if not is_homogeneous(nets) or has_cumulative_batch_norm(nets):
+            raise ValueError("These trials can not be stacked")
+
+        self.nets = nets
+        self.samples = samples
+
+        # parameters stay stacked for the whole run, the trial networks only
+        # receive them for validation and saving
+        params, buffers = stack_module_state(nets)
+        self.params = {name: p.detach().clone().requires_grad_() for name, p in params.items()}
+        self.buffers = {name: b.clone() for name, b in buffers.items()}
+        self.optimizer = StackedOptimizer(self.params, [net.optimizer for net in nets])
+
+        def call(params, buffers, inputs):
+            return functional_call(nets[0], (params, buffers), (inputs,))
+
+        self.forward = vmap(call, in_dims=(0, 0, None), randomness="different")
+
+        # one loss per trial and sample, summed so that every trial gets only its own gradient
+        self.loss_func = vmap(vmap(nets[0].loss_func, in_dims=(0, None)), in_dims=(0, None))
+
+        for net in nets:
+            net.train()
+
+    def train_step(self, data, target):
+
+        samples = self.samples
+        inputs = data.repeat(samples, *[1] * (data.dim() - 1)) if samples > 1 else data
+        outputs = self.forward(self.params, self.buffers, inputs)
+        outputs = outputs.reshape(len(self.nets), samples, len(data), *outputs.shape[2:])
+
+        losses = self.loss_func(outputs, target).mean(1)
+        losses.sum().backward()
+
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+
+        labels = outputs.detach().mean(1).argmax(-1)
+        correct = (labels == target.unsqueeze(0)).sum(-1)
+
+        return losses.detach(), correct
+
+    def unstack(self):
+        unstack_parameters(self.nets, self.params)
+        unstack_buffers(self.nets, self.buffers)
+        self.optimizer.unstack_state(self.nets)
+
+
+def train_stacked(
+    network_name,
+    network_type,
+    dataset_name,
+    batch,
+    epochs,
+    trials,
+    samples=1,
+    save_steps=-1,
+    validation_steps=-1,
+    optimizer=None,
+    loss="cross_entropy",
+    device="cuda:0",
+    save_best=True,
+    allow_retrain: bool = True,
+    all_models_path="./models",
+    metric_window: int = 100,
+    summary_steps: int = 50,
+    log_steps: Optional[int] = None,
+    dataset_cache: bool = False,
+    shared_runtime: bool = False,
+    start_global_std=None,
+    end_global_std=None,
+    **kwargs,
+):
+
+    if loss in loss_functions_that_use_network:
+        raise ValueError("Loss '" + loss + "' can not be used with stacked trials")
+
+    # the global std schedule is a class attribute, which all trials of a stack would share
+    if start_global_std is not None:
+        raise ValueError("Global std schedules can not be used with stacked trials")
+
+    for trial in trials:
+        for key in trial.keys():
+            if not is_stackable_key(key):
+                raise ValueError("Trial parameter '" + key + "' can not be stacked")
+
+    if optimizer is None:
+        optimizer = "SGD"
+        kwargs["optimizer_lr"] = 0.001
+        kwargs["optimizer_momentum"] = 0.9
+
+    device = torch.device(device if torch.cuda.is_available() else "cpu")
+
+    nets = []
+    model_paths = []
+    descriptions = []
+
+    for trial in trials:
+        trial_kwargs = {**kwargs, **trial}
+        seed = trial_kwargs.pop("seed", None)
+        model_suffix = trial_kwargs.pop("model_suffix", "")
+
+        model_path, _ = create_model_path(
+            network_name, network_type, dataset_name, model_suffix, all_models_path
+        )
+
+        if (not allow_retrain) and os.path.exists(model_path + "/best/model.pth"):
+            print("Already exists", model_path)
+            continue
+
+        create_model_directories(model_path)
+
+        save_kwargs = {
+            "network_name": network_name,
+            "network_type": network_type,
+            "dataset_name": dataset_name,
+            "batch": batch,
+            "epochs": epochs,
+            "model_path": model_path,
+            "model_suffix": model_suffix,
+            "save_steps": save_steps,
+            "validation_steps": validation_steps,
+            "optimizer": optimizer,
+            "loss": loss,
+            "device": str(device),
+            "save_best": save_best,
+            "start_global_std": start_global_std,
+            "end_global_std": end_global_std,
+            **trial_kwargs,
+        }
+
+        def create_current_model_description(path, save_kwargs=save_kwargs):
+            create_model_description(path, **save_kwargs)
+
+        create_current_model_description(model_path)
+
+        net = create_trial_network(network_name, network_type, optimizer, loss, batch, seed, trial_kwargs)
+        net.to(device)
+
+        nets.append(net)
+        model_paths.append(model_path)
+        descriptions.append(create_current_model_description)
+
+    if len(nets) == 0:
+        return
+
+    def create_datasets():
+        return create_train_validation_test(dataset_params[dataset_name], dataset_cache)
+
+    if shared_runtime:
+        train, val, _ = SweepRuntime.get_datasets((dataset_name, dataset_cache, False), create_datasets)
+    else:
+        train, val, _ = create_datasets()
+
+    data_seed = int(torch.randint(0, 2**31 - 1, ()))
+
+    train = create_data_loader(train, batch, shuffle=True, num_workers=4, seed=data_seed)
+    val = create_data_loader(val, batch, shuffle=False, num_workers=4)
+
+    if save_steps < 0:
+        save_steps = -save_steps * len(train)
+
+    if validation_steps < 0:
+        validation_steps = -validation_steps * len(train)
+
+    stacked = StackedTrials(nets, samples)
+
+    # metrics hold one value per trial
+    current_step = 0
+    window_accuracy_metric = WindowedAverageMetric(metric_window)
+    loss_metric = ExponentialMovingAverageMetric()
+    throughput_metric = WindowedAverageMetric(metric_window)
+
+    if log_steps is None:
+        log_steps = summary_steps
+
+    writers = [BatchedSummaryWriter(SummaryWriter(path + "/summary"), summary_steps) for path in model_paths]
+
+    # queued summaries are written even if a trial fails
+    try:
+        for epoch in range(epochs):
+
+            accuracy_metric = AverageMetric()
+            set_loader_epoch(train, epoch)
+            step_start = time.time()
+
+            for i, (data, target) in enumerate(train):
+
+                data = data.to(device)
+                target = target.to(device)
+
+                current_step += 1
+
+                losses, correct = stacked.train_step(data, target)
+
+                step_end = time.time()
+                throughput_metric.update(len(data) * len(nets) / (step_end - step_start))
+                step_start = step_end
+
+                accuracy_metric.update(correct / batch)
+                window_accuracy_metric.update(correct / batch)
+                loss_metric.update(losses)
+
+                for k, writer in enumerate(writers):
+                    writer.add_scalar("loss", losses[k], current_step)
+                    writer.add_scalar("acc", accuracy_metric.get()[k], current_step)
+                    writer.add_scalar("window_acc", window_accuracy_metric.get()[k], current_step)
+                    writer.add_scalar("loss_ema", loss_metric.get()[k], current_step)
+                    writer.add_scalar("epoch", epoch + 1, current_step)
+                    writer.add_scalar("samples_per_second", throughput_metric.get() / len(nets), current_step)
+                    writer.step()
+
+                if current_step % log_steps == 0:
+                    print(
+                        network_name + "_" + network_type + " x" + str(len(nets))
+                        + " e[" + str(epoch + 1) + "/" + str(epochs) + "]"
+                        + " s[" + str(i + 1) + "/" + str(len(train)) + "]"
+                        + " loss=" + str([round(float(value), 4) for value in losses])
+                        + " acc=" + str([round(float(value), 4) for value in accuracy_metric.get()])
+                        + " sps=" + str(round(throughput_metric.get(), 1))
+                    )
+
+                if current_step % save_steps == 0 or current_step % validation_steps == 0:
+                    stacked.unstack()
+
+                for k, net in enumerate(nets):
+
+                    if current_step % save_steps == 0:
+                        net.save(model_paths[k])
+
+                    if current_step % validation_steps == 0:
+                        val_acc = run_evaluation(net, val, device, correct_count, batch, samples)
+                        record_validation(
+                            net, val_acc, model_paths[k], writers[k], epoch, current_step,
+                            validation_steps % len(train) == 0, batch, samples, save_best, descriptions[k],
+                        )
+
+        stacked.unstack()
+
+        for k, net in enumerate(nets):
+            # same completion marker as train, so queues and resumes skip these runs
+            net.save(model_paths[k], current_step, {
+                "step": current_step,
+                "epoch": epochs,
+                "batch": 0,
+                "data_seed": data_seed,
+                "global_std": VariationalBase.GLOBAL_STD,
+                "rng": get_rng_states(),
+                "finished": True,
+            })
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+if __name__ == "__main__":
+
+    fire.Fire()
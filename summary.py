@@ -0,0 +1,84 @@
+from queue import Queue
+from threading import Thread
+import torch
+
+
+class NullSummaryWriter:
+
+    # stands in for the writer on ranks that do not write summaries
+    def add_scalar(self, tag, value, step):
+        pass
+
+    def step(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class BatchedSummaryWriter:
+    def __init__(self, writer, flush_steps=50) -> None:
+        self.writer = writer
+        self.flush_steps = flush_steps
+        self.pending = []
+        self.steps = 0
+
+        self.queue: Queue = Queue()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add_scalar(self, tag, value, step):
+
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+
+        self.pending.append((tag, value, step))
+
+    def step(self):
+
+        self.steps += 1
+
+        if self.steps % self.flush_steps == 0:
+            self.flush()
+
+    def flush(self):
+
+        if len(self.pending) > 0:
+            self.queue.put(self.pending)
+            self.pending = []
+
+    def run(self):
+
+        while True:
+            scalars = self.queue.get()
+
+            if scalars is None:
+                self.queue.task_done()
+                return
+
+            values = [value for _, value, _ in scalars]
+            devices = {value.device for value in values if isinstance(value, torch.Tensor)}
+
+            # one host transfer per device for all tensor values of the batch
+            for device in devices:
+                indices = [
+                    i for i, value in enumerate(values) if isinstance(value, torch.Tensor) and value.device == device
+                ]
+                host_values = torch.stack([values[i].float().reshape([]) for i in indices]).cpu().tolist()
+
+                for i, value in zip(indices, host_values):
+                    values[i] = value
+
+            for (tag, _, step), value in zip(scalars, values):
+                self.writer.add_scalar(tag, value, step)
+
+            self.queue.task_done()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
@@ -0,0 +1,57 @@
+from threading import Lock
+
+from params import create_network
+
+
+class SweepRuntime:
+
+    # datasets, splits and loader workers stay resident between train calls of one process,
+    # so consecutive sweep jobs on the same dataset only pay the setup once
+    datasets: dict = {}
+    loaders: dict = {}
+    network_factories: dict = {}
+    lock = Lock()
+
+    @classmethod
+    def get_datasets(cls, key, create):
+
+        with cls.lock:
+            if key not in cls.datasets:
+                cls.datasets[key] = create()
+
+            return cls.datasets[key]
+
+    @classmethod
+    def get_network_factory(cls, network_name, network_type):
+
+        with cls.lock:
+            key = (network_name, network_type)
+
+            if key not in cls.network_factories:
+                cls.network_factories[key] = create_network(network_name, network_type)
+
+            return cls.network_factories[key]
+
+    @classmethod
+    def acquire_loader(cls, key, create):
+
+        # a loader is only handed to one job at a time
+        with cls.lock:
+            free = cls.loaders.setdefault(key, [])
+
+            if len(free) > 0:
+                return free.pop()
+
+        return create()
+
+    @classmethod
+    def release_loader(cls, key, loader):
+        with cls.lock:
+            cls.loaders.setdefault(key, []).append(loader)
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.datasets = {}
+            cls.loaders = {}
+            cls.network_factories = {}
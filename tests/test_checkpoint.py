@@ -0,0 +1,182 @@
+import json
+import threading
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torchvision import transforms
+
+import main
+from main import create_model_directories, process_activation_kwargs, record_validation
+from networks import checkpoint
+from networks.checkpoint import CheckpointWriter, latest_checkpoint_path, load_training_state, write_checkpoint
+from networks.network import Network
+from params import create_network
+from summary import NullSummaryWriter
+
+
+def create_test_network():
+    net = create_network("mnist_mini_base", "classic")(**process_activation_kwargs({"activation": "relu"}))
+    net.prepare_train(torch.optim.SGD, {"lr": 0.01}, torch.nn.CrossEntropyLoss(), False, 4)
+    return net
+
+
+def test_best_model_ignores_queued_descriptions(tmp_path):
+
+    model_path = str(tmp_path / "model")
+    create_model_directories(model_path)
+
+    net = create_test_network()
+    net.checkpoint_writer = CheckpointWriter(asynchronous=True)
+
+    # holds the writer back, so no description reaches the disk during validation
+    release = threading.Event()
+    net.checkpoint_writer.submit(release.wait)
+
+    for step, accuracy in enumerate([0.5, 0.4, 0.45]):
+        record_validation(
+            net, accuracy, model_path, NullSummaryWriter(), 0, step, False, 4, 1, True, lambda path: None,
+        )
+
+    release.set()
+    net.checkpoint_writer.close()
+
+    with open(model_path + "/best/description.json") as file:
+        assert json.load(file)["result"] == 0.5
+
+
+class FakeDataset(torch.utils.data.Dataset):
+    def __init__(self, path, train=True, download=False, transform=None):
+        random = np.random.RandomState(0 if train else 1)
+        self.images = random.randint(0, 256, (64 if train else 16, 28, 28)).astype(np.uint8)
+        self.targets = (self.images.mean((1, 2)) > 127.5).astype(int)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        image = Image.fromarray(self.images[index], mode="L")
+        return (image if self.transform is None else self.transform(image)), int(self.targets[index])
+
+
+def train_fake(model_path, **kwargs):
+    main.train(
+        "mnist_mini_base", "vnn", "fake", 8, 2, model_path=model_path, device="cpu", dataset_cache=True,
+        activation="relu", log_steps=100, validation_steps=-1, save_steps=4, samples=2, **kwargs,
+    )
+
+
+def use_fake_dataset(tmp_path, monkeypatch):
+    monkeypatch.setitem(main.dataset_params, "fake", {
+        "dataset": FakeDataset,
+        "path": str(tmp_path) + "/data/",
+        "train_size": 48,
+        "validation_size": 16,
+        "transform": {"all": transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.5,), (0.3,))])},
+    })
+
+
+def test_resumed_training_matches_uninterrupted_training(tmp_path, monkeypatch):
+
+    use_fake_dataset(tmp_path, monkeypatch)
+
+    torch.manual_seed(0)
+    train_fake(str(tmp_path / "straight"))
+
+    train_step = Network.train_step
+    calls = [0]
+
+    def preempted_train_step(self, *args, **kwargs):
+        calls[0] += 1
+
+        if calls[0] == 7:
+            raise KeyboardInterrupt()
+
+        return train_step(self, *args, **kwargs)
+
+    monkeypatch.setattr(Network, "train_step", preempted_train_step)
+    torch.manual_seed(0)
+
+    with pytest.raises(KeyboardInterrupt):
+        train_fake(str(tmp_path / "resumed"))
+
+    monkeypatch.setattr(Network, "train_step", train_step)
+
+    assert latest_checkpoint_path(str(tmp_path / "resumed")).endswith("/checkpoints/4")
+    assert load_training_state(str(tmp_path / "resumed"))["step"] == 4
+
+    # the rng states come from the checkpoint
+    torch.manual_seed(1)
+    train_fake(str(tmp_path / "resumed"), resume=True)
+
+    straight = torch.load(str(tmp_path / "straight/model.pth"))
+    resumed = torch.load(str(tmp_path / "resumed/model.pth"))
+
+    for key in straight.keys():
+        assert torch.equal(straight[key], resumed[key])
+
+
+def test_interrupted_checkpoint_keeps_previous_step(tmp_path, monkeypatch):
+
+    save_path = str(tmp_path)
+    write_checkpoint(save_path, {"model.pth": 1, "optimizer.pth": 1, "training_state.pth": {"step": 1}}, 1)
+
+    def failing_save(value, path):
+        if path.endswith("optimizer.pth"):
+            raise OSError("disk full")
+
+        checkpoint.atomic_save.__wrapped__(value, path)
+
+    failing_save.__wrapped__ = checkpoint.atomic_save
+    monkeypatch.setattr(checkpoint, "atomic_save", failing_save)
+
+    with pytest.raises(OSError):
+        write_checkpoint(save_path, {"model.pth": 2, "optimizer.pth": 2, "training_state.pth": {"step": 2}}, 2)
+
+    checkpoint_path = latest_checkpoint_path(save_path)
+
+    assert load_training_state(save_path)["step"] == 1
+    assert torch.load(checkpoint_path + "/model.pth") == 1
+    assert torch.load(checkpoint_path + "/optimizer.pth") == 1
+
+
+def test_failed_training_writes_queued_summaries(tmp_path, monkeypatch):
+
+    use_fake_dataset(tmp_path, monkeypatch)
+
+    class RecordingWriter:
+        def __init__(self, path):
+            self.steps = set()
+            self.closed = False
+            writers.append(self)
+
+        def add_scalar(self, tag, value, step):
+            self.steps.add(step)
+
+        def close(self):
+            self.closed = True
+
+    writers = []
+    monkeypatch.setattr(main, "SummaryWriter", RecordingWriter)
+
+    train_step = Network.train_step
+    calls = [0]
+
+    def failing_train_step(self, *args, **kwargs):
+        calls[0] += 1
+
+        if calls[0] == 4:
+            raise RuntimeError()
+
+        return train_step(self, *args, **kwargs)
+
+    monkeypatch.setattr(Network, "train_step", failing_train_step)
+
+    # the default summary interval of 50 steps is never reached before the failure
+    with pytest.raises(RuntimeError):
+        train_fake(str(tmp_path / "failed"))
+
+    assert writers[0].closed
+    assert writers[0].steps == {1, 2, 3}
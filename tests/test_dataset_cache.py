@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from torchvision import transforms
+
+from dataset_cache import create_cached_train_validation_test, write_cache
+
+
+class FakeDataset(torch.utils.data.Dataset):
+    def __init__(self, path, train=True, download=False, transform=None):
+        random = np.random.RandomState(0 if train else 1)
+        self.images = random.randint(0, 256, (32 if train else 8, 4, 4)).astype(np.uint8)
+        self.targets = np.arange(len(self.images))
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.images[index], int(self.targets[index])
+
+
+def fake_params(path):
+    return {"dataset": FakeDataset, "path": str(path) + "/", "train_size": 12, "validation_size": 4}
+
+
+def cached_targets(path, split_seed):
+
+    transform = transforms.ToTensor()
+    train, val, test = create_cached_train_validation_test(fake_params(path), transform, transform, split_seed)
+
+    return np.concatenate([train.slice(0, len(train))[1].numpy(), val.slice(0, len(val))[1].numpy()])
+
+
+def test_split_follows_the_seed_in_the_cache_name(tmp_path):
+
+    first = cached_targets(tmp_path / "first", 3)
+    second = cached_targets(tmp_path / "second", 3)
+
+    torch.manual_seed(0)
+    other = cached_targets(tmp_path / "first", 4)
+
+    expected = torch.randperm(32, generator=torch.Generator().manual_seed(3)).numpy()[:16]
+
+    assert np.array_equal(first, expected)
+    assert np.array_equal(second, expected)
+    assert not np.array_equal(other, expected)
+    assert sorted(os.listdir(tmp_path / "first/cache/FakeDataset")) == ["test", "train_12_4_seed3", "train_12_4_seed4"]
+
+
+def test_failed_build_publishes_nothing(tmp_path):
+
+    class BrokenDataset(FakeDataset):
+        def __getitem__(self, index):
+            if index == 5:
+                raise RuntimeError()
+
+            return super().__getitem__(index)
+
+    with pytest.raises(RuntimeError):
+        write_cache(BrokenDataset(None), str(tmp_path / "cache"))
+
+    assert os.listdir(tmp_path) == []
+
+    write_cache(FakeDataset(None), str(tmp_path / "cache"))
+
+    assert os.listdir(tmp_path) == ["cache"]
+    assert sorted(os.listdir(tmp_path / "cache")) == ["images.npy", "split.npy", "targets.npy"]
+
+
+def test_waiting_process_uses_the_published_cache(tmp_path, monkeypatch):
+
+    cache_path = str(tmp_path / "cache")
+    open(cache_path + ".lock", "w").close()
+
+    # the lock holder publishes the cache while this process waits
+    def publish(seconds):
+        os.rename(cache_path + ".lock", cache_path + ".done")
+        write_cache(FakeDataset(None), cache_path)
+        os.rename(cache_path + ".done", cache_path + ".lock")
+
+    monkeypatch.setattr("dataset_cache.time.sleep", publish)
+
+    write_cache(FakeDataset(None, train=False), cache_path)
+
+    assert os.path.exists(cache_path + ".lock")
+    assert len(np.load(cache_path + "/targets.npy")) == 32
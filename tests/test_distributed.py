@@ -0,0 +1,45 @@
+import datetime
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from distributed import all_reduce_gradients, destroy_process_group
+
+
+def reduce_partial_gradients(rank, world_size, port):
+
+    dist.init_process_group(
+        "gloo",
+        init_method="tcp://127.0.0.1:" + str(port),
+        rank=rank,
+        world_size=world_size,
+        timeout=datetime.timedelta(seconds=60),
+    )
+
+    try:
+        module = torch.nn.ModuleList([torch.nn.Linear(2, 2, bias=False) for _ in range(3)])
+
+        # the first member is sampled on every rank, the second only on rank 0, the third nowhere
+        module[0].weight.grad = torch.full((2, 2), float(rank + 1))
+
+        if rank == 0:
+            module[1].weight.grad = torch.full((2, 2), 4.0)
+
+        all_reduce_gradients(module)
+
+        assert torch.equal(module[0].weight.grad, torch.full((2, 2), 1.5))
+        assert torch.equal(module[1].weight.grad, torch.full((2, 2), 2.0))
+        assert module[2].weight.grad is None
+    finally:
+        destroy_process_group()
+
+
+def test_unsampled_members_keep_no_gradient():
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    mp.spawn(reduce_partial_gradients, args=(2, port), nprocs=2)
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+import torch
+
+from main import process_activation_kwargs
+from networks.layer_ensemble import SamplePlan, SamplePlanCache, sample_layer_ensembles
+from params import create_network
+
+
+def create_test_network(**kwargs):
+    kwargs = process_activation_kwargs({"activation": "relu", "num_ensemble": 3, **kwargs})
+    return create_network("mnist_mini_base", "layer_ensemble")(**kwargs)
+
+
+def test_fixed_plan_only_in_eval():
+
+    torch.manual_seed(0)
+    net = create_test_network(plan_seed=0)
+
+    net.eval()
+    assert net.sample_plan(10) is net.sample_plan(10)
+
+    net.train()
+    assert not np.array_equal(net.sample_plan(10).samples, net.sample_plan(10).samples)
+
+
+def test_plan_cache_evicts_least_recently_used():
+
+    cache = SamplePlanCache(max_size=2)
+    first = cache.get([3, 3], 4, 0)
+    cache.get([3, 3], 4, 1)
+
+    assert cache.get([3, 3], 4, 0) is first
+
+    cache.get([3, 3], 5, 0)
+
+    assert cache.get([3, 3], 4, 0) is first
+    assert len(cache.plans) == 2
+
+
+def test_plan_prefix_nodes_match_unique_rows():
+
+    plan = SamplePlan(sample_layer_ensembles([3, 3, 3, 3], 20, np.random.RandomState(0)))
+
+    for layers in range(1, 5):
+        representatives, inverse = plan.nodes(list(range(layers)))
+        _, unique_representatives, unique_inverse = np.unique(
+            plan.samples[:, :layers], axis=0, return_index=True, return_inverse=True
+        )
+
+        assert np.array_equal(representatives, unique_representatives)
+        assert np.array_equal(inverse, unique_inverse.reshape(-1))
+
+
+def create_copies(*kwargs_list, **kwargs):
+
+    torch.manual_seed(0)
+    nets = [create_test_network(**kwargs, **current) for current in kwargs_list]
+
+    for net in nets[1:]:
+        net.load_state_dict(nets[0].state_dict())
+
+    return nets
+
+
+def assert_same_outputs(first, second):
+
+    assert len(first) == len(second)
+
+    for a, b in zip(first, second):
+        assert torch.allclose(a, b, atol=1e-5)
+
+
+@pytest.mark.parametrize("training", [False, True])
+def test_vectorized_matches_looped(training):
+
+    looped, vectorized = create_copies({}, {"stacked": True})
+    looped.train(training)
+    vectorized.train(training)
+
+    x = torch.randn(4, 1, 28, 28)
+    plan = SamplePlan(sample_layer_ensembles(looped.num_ensembles, 6, np.random.RandomState(0)))
+
+    assert_same_outputs(looped.batched(x, plan), vectorized.batched(x, plan))
+
+
+@pytest.mark.parametrize("stacked", [False, True])
+def test_prefix_sharing_matches_plain(stacked):
+
+    plain, shared = create_copies({}, {"prefix_sharing": True}, stacked=stacked)
+    plain.eval()
+    shared.eval()
+
+    x = torch.randn(4, 1, 28, 28)
+    plan = SamplePlan(sample_layer_ensembles(plain.num_ensembles, 20, np.random.RandomState(0)))
+
+    with torch.no_grad():
+        assert_same_outputs(plain.batched(x, plan), shared.batched(x, plan))
+
+    assert shared.saved_evaluations > 0
+
+
+def test_prefix_sharing_skips_batch_norm_training():
+
+    shared, vectorized = create_copies({"prefix_sharing": True}, {"stacked": True}, use_batch_norm=True)
+
+    x = torch.randn(4, 1, 28, 28)
+    plan = SamplePlan(sample_layer_ensembles(vectorized.num_ensembles, 20, np.random.RandomState(0)))
+
+    # batch statistics count every sample, so training runs without sharing
+    assert_same_outputs(vectorized.batched(x, plan), shared.batched(x, plan))
+    assert shared.evaluations == 0
+
+    vectorized.eval()
+    shared.eval()
+
+    with torch.no_grad():
+        assert_same_outputs(vectorized.batched(x, plan), shared.batched(x, plan))
+
+    assert shared.saved_evaluations > 0
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import torch
+
+from metrics import OnlineMeanStdMetric
+
+
+@pytest.mark.parametrize("inplace", [False, True])
+@pytest.mark.parametrize("chunks", [[1], [5], [1, 7], [3, 0, 4, 1], [10, 10, 10]])
+def test_merged_stats_match_two_pass(chunks, inplace):
+
+    random = np.random.RandomState(0)
+    values = random.normal(3.0, 2.0, (sum(chunks), 4, 2))
+
+    merged = OnlineMeanStdMetric()
+    start = 0
+
+    for size in chunks:
+        metric = OnlineMeanStdMetric(inplace)
+
+        for value in values[start:start + size]:
+            metric.update(value.copy())
+
+        merged.merge(metric)
+        start += size
+
+    mean, std = merged.get(eps=0)
+
+    assert merged.count == len(values)
+    assert np.allclose(mean, values.mean(0))
+    assert np.allclose(std, values.std(0))
+
+
+def test_tensor_stats_match_two_pass():
+
+    values = torch.randn(9, 3, generator=torch.Generator().manual_seed(0), dtype=torch.float64)
+
+    first, second = OnlineMeanStdMetric(), OnlineMeanStdMetric()
+
+    for value in values[:4]:
+        first.update(value)
+
+    for value in values[4:]:
+        second.update(value)
+
+    mean, std = first.merge(second).get(eps=0)
+
+    assert torch.allclose(mean, values.mean(0))
+    assert torch.allclose(std, values.std(0, unbiased=False))
+
+
+def test_variance_without_spread_is_zero():
+
+    metric = OnlineMeanStdMetric()
+
+    assert metric.variance() == 0
+
+    metric.update(np.array([1.0, 2.0]))
+
+    assert np.array_equal(metric.variance(), np.zeros(2))
+    assert np.array_equal(metric.get(eps=0)[1], np.zeros(2))
@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from main import process_activation_kwargs
+from networks.network import SampledNetwork
+from params import create_network
+
+
+network_kwargs = {
+    "vnn": {},
+    "vnn_fused": {},
+    "dropout": {"dropout_probability": 0.5},
+    "bbb": {"index_scale": 1},
+    "hypermodel": {"index_dim": 4, "index_scale": 1},
+    "ensemble_vnn": {"num_ensemble": 2},
+    "ensemble_dropout": {"num_ensemble": 2, "dropout_probability": 0.5},
+    "ensemble_bbb": {"num_ensemble": 2, "index_scale": 1},
+    "ensemble_hypermodel": {"num_ensemble": 2, "index_dim": 4, "index_scale": 1},
+    "layer_ensemble": {"num_ensemble": 2, "average_results": True},
+}
+
+
+def create_test_network(network_type):
+    kwargs = process_activation_kwargs({"activation": "relu", **network_kwargs[network_type]})
+    return create_network("mnist_mini_base", network_type)(**kwargs)
+
+
+@pytest.mark.parametrize("network_type", list(network_kwargs.keys()))
+def test_samples_differ(network_type):
+
+    torch.manual_seed(0)
+    net = create_test_network(network_type)
+    net.train()
+
+    outputs = []
+
+    def capture(samples):
+        outputs.append(samples)
+        return samples
+
+    samples = 4
+    sampled = SampledNetwork(net, samples, capture)
+
+    with torch.no_grad():
+        sampled(torch.randn(3, 1, 28, 28))
+
+    assert outputs[0].shape[0] == samples
+
+    for i in range(samples):
+        for k in range(i + 1, samples):
+            assert not torch.allclose(outputs[0][i], outputs[0][k])
+
+
+@pytest.mark.parametrize("network_type", ["layer_ensemble", "hypermodel", "ensemble_bbb", "ensemble_hypermodel"])
+def test_batch_shared_samples_are_not_batched(network_type):
+    assert not create_test_network(network_type).batch_samples
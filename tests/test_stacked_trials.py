@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from stacked_trials import StackedTrials, create_trial_network, train_stacked
+
+
+def create_trials(optimizer, trials):
+    return [
+        create_trial_network(
+            "mnist_mini_base", "classic", optimizer, "cross_entropy", 4, seed,
+            {"activation": "relu", "optimizer_lr": lr},
+        )
+        for seed, lr in trials
+    ]
+
+
+# adam divides by the gradient magnitude, which amplifies rounding differences of tiny gradients
+@pytest.mark.parametrize("optimizer, tolerance", [("SGD", 1e-6), ("Adam", 1e-4)])
+def test_stacked_trials_match_individual_training(optimizer, tolerance):
+
+    trials = [(0, 0.01), (1, 0.001), (2, 0.003)]
+    stacked_nets = create_trials(optimizer, trials)
+    nets = create_trials(optimizer, trials)
+
+    stacked = StackedTrials(stacked_nets)
+
+    torch.manual_seed(3)
+    batches = [(torch.randn(4, 1, 28, 28), torch.randint(0, 10, (4,))) for _ in range(3)]
+
+    for data, target in batches:
+        stacked.train_step(data, target)
+
+        for net in nets:
+            net.train_step(data, target)
+
+    stacked.unstack()
+
+    for stacked_net, net in zip(stacked_nets, nets):
+        for stacked_parameter, parameter in zip(stacked_net.parameters(), net.parameters()):
+            assert torch.allclose(stacked_parameter, parameter, atol=tolerance)
+
+
+def test_global_std_schedule_is_not_stacked():
+    with pytest.raises(ValueError):
+        train_stacked(
+            "mnist_mini_base", "vnn", "mnist", 4, 1, [{"model_suffix": "a"}],
+            start_global_std=1, end_global_std=0.5,
+        )
@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from main import process_activation_kwargs
+from networks.variational import VariationalBase
+from params import create_network
+
+
+def create_test_network(network_type, **kwargs):
+    kwargs = process_activation_kwargs({"activation": "relu", **kwargs})
+    return create_network("mnist_mini_base", network_type)(**kwargs)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"use_batch_norm": True}, {"global_std_mode": "multiply"}])
+def test_fused_matches_unfused(kwargs, monkeypatch):
+
+    monkeypatch.setattr(VariationalBase, "GLOBAL_STD", 0.5)
+    torch.manual_seed(0)
+    unfused = create_test_network("vnn", **kwargs)
+    fused = create_test_network("vnn_fused", **kwargs)
+    fused.load_state_dict(unfused.state_dict())
+
+    x = torch.randn(4, 1, 28, 28)
+    outputs = []
+
+    for net in [unfused, fused]:
+        torch.manual_seed(1)
+        output = net(x)
+        output.sum().backward()
+        outputs.append(output)
+
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-5)
+
+    # the fused projection holds the mean and std weights of one layer
+    for layer, fused_layer in zip(unfused.model, fused.model):
+        if hasattr(fused_layer, "projection"):
+            gradient = torch.cat([
+                module.weight.grad for module in layer.modules()
+                if isinstance(module, (torch.nn.Conv2d, torch.nn.Linear))
+            ])
+
+            assert torch.allclose(gradient, fused_layer.projection.weight.grad, atol=1e-4)
@@ -0,0 +1,299 @@
+import glob
+import json
+import os
+import re
+import sqlite3
+import time
+
+from networks.checkpoint import load_training_state
+
+
+def job_group(network_name, dataset_name, kwargs):
+
+    # jobs of the same group are expected to take about the same time
+    return (
+        dataset_name + "_" + network_name + "_" + kwargs["network_type"]
+        + "_e" + str(kwargs.get("epochs")) + "_b" + str(kwargs.get("batch"))
+    )
+
+
+def is_completed(model_path):
+
+    state = load_training_state(model_path)
+
+    if state is not None:
+        return state["finished"]
+
+    return os.path.exists(model_path + "/best/model.pth")
+
+
+def rung_epochs(rung, min_epochs, reduction, epochs):
+    return min(epochs, min_epochs * reduction ** rung)
+
+
+def validation_score(model_path, max_epoch):
+
+    # best per epoch validation accuracy written by train up to max_epoch,
+    # runs that validate by steps fall back to the best description
+    scores = []
+
+    for path in glob.glob(model_path + "/results/validation_batch_*.txt"):
+        with open(path) as file:
+            for line in file:
+                match = re.match(r"epoch (\d+): \(?(?:tensor\()?([-+0-9.eE]+)", line)
+
+                if match is not None and int(match.group(1)) <= max_epoch:
+                    scores.append(float(match.group(2)))
+
+    if len(scores) > 0:
+        return max(scores)
+
+    description_path = model_path + "/best/description.json"
+
+    if os.path.exists(description_path):
+        with open(description_path) as file:
+            return float(json.load(file)["result"])
+
+    return None
+
+
+class Job:
+    def __init__(self, id, network_name, dataset_name, kwargs, group, attempts, rung=0) -> None:
+        self.id = id
+        self.network_name = network_name
+        self.dataset_name = dataset_name
+        self.kwargs = kwargs
+        self.group = group
+        self.attempts = attempts
+        self.rung = rung
+
+    def name(self):
+        return self.network_name + " " + self.kwargs["network_type"] + " " + self.kwargs.get("model_suffix", "")
+
+
+class WorkQueue:
+    def __init__(self, path) -> None:
+        self.path = path
+
+        directory = os.path.dirname(path)
+
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        with self.transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY, "
+                "key TEXT UNIQUE, "
+                "network_name TEXT, "
+                "dataset_name TEXT, "
+                "kwargs TEXT, "
+                "job_group TEXT, "
+                "exclusive INTEGER DEFAULT 0, "
+                "status TEXT DEFAULT 'pending', "
+                "attempts INTEGER DEFAULT 0, "
+                "available_at REAL DEFAULT 0, "
+                "worker TEXT, "
+                "heartbeat REAL, "
+                "duration REAL, "
+                "error TEXT, "
+                "rung INTEGER DEFAULT 0)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS rung_results ("
+                "job_id INTEGER, "
+                "rung INTEGER, "
+                "score REAL, "
+                "PRIMARY KEY (job_id, rung))"
+            )
+
+            # queues created before successive halving have no rung column
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(jobs)")]
+
+            if "rung" not in columns:
+                connection.execute("ALTER TABLE jobs ADD COLUMN rung INTEGER DEFAULT 0")
+
+    def transaction(self):
+        return Transaction(self.path)
+
+    def enqueue(self, models):
+
+        added = 0
+
+        with self.transaction() as connection:
+            for network_name, dataset_name, kwargs in models:
+                key = json.dumps([network_name, dataset_name, kwargs], sort_keys=True)
+                # the global std schedule is a class attribute, so these runs can not share a process
+                exclusive = kwargs.get("start_global_std") is not None
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO jobs (key, network_name, dataset_name, kwargs, job_group, exclusive) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        key, network_name, dataset_name, json.dumps(kwargs),
+                        job_group(network_name, dataset_name, kwargs), exclusive,
+                    ),
+                )
+                added += cursor.rowcount
+
+        return added
+
+    def claim(self, worker, stale_seconds=3600, max_attempts=3, packable_groups=None, reduction=None):
+
+        now = time.time()
+
+        with self.transaction() as connection:
+
+            # jobs of workers that stopped sending heartbeats count as a failed attempt
+            connection.execute(
+                "UPDATE jobs SET attempts = attempts + 1, worker = NULL, error = 'worker lost', "
+                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                "WHERE status = 'running' AND heartbeat < ?",
+                (max_attempts, now - stale_seconds),
+            )
+
+            if reduction is not None:
+                job = self.promote(connection, worker, reduction, packable_groups)
+
+                if job is not None:
+                    return job
+
+            query = "SELECT id, network_name, dataset_name, kwargs, job_group, attempts, rung FROM jobs "
+            query += "WHERE status = 'pending' AND available_at <= ? "
+            arguments: list = [now]
+
+            if packable_groups is not None:
+                query += "AND exclusive = 0 AND job_group IN (" + ", ".join("?" * len(packable_groups)) + ") "
+                arguments += packable_groups
+
+            row = connection.execute(query + "ORDER BY id LIMIT 1", arguments).fetchone()
+
+            if row is None:
+                return None
+
+            connection.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, heartbeat = ? WHERE id = ?",
+                (worker, now, row[0]),
+            )
+
+        id, network_name, dataset_name, kwargs, group, attempts, rung = row
+
+        return Job(id, network_name, dataset_name, json.loads(kwargs), group, attempts, rung)
+
+    def promote(self, connection, worker, reduction, packable_groups=None):
+
+        # asynchronous successive halving, a paused job moves up as soon as it is in the top
+        # 1 / reduction of its rung, compared only with runs of the same network, network type and dataset
+        rows = connection.execute(
+            "SELECT r.rung, r.score, j.id, j.network_name, j.dataset_name, j.kwargs, j.job_group, j.attempts, "
+            "j.status, j.rung, j.exclusive FROM rung_results r JOIN jobs j ON j.id = r.job_id "
+            "WHERE r.score IS NOT NULL ORDER BY r.rung DESC, r.score DESC"
+        ).fetchall()
+
+        results: dict = {}
+
+        for row in rows:
+            results.setdefault((row[0], row[3], json.loads(row[5])["network_type"], row[4]), []).append(row)
+
+        for (rung, _, _, _), rung_rows in results.items():
+            for row in rung_rows[:len(rung_rows) // reduction]:
+                _, _, id, network_name, dataset_name, kwargs, group, attempts, status, job_rung, exclusive = row
+
+                if status != "paused" or job_rung != rung:
+                    continue
+
+                if packable_groups is not None and (exclusive or group not in packable_groups):
+                    continue
+
+                connection.execute(
+                    "UPDATE jobs SET status = 'running', rung = ?, worker = ?, heartbeat = ?, attempts = 0 "
+                    "WHERE id = ?",
+                    (rung + 1, worker, time.time(), id),
+                )
+
+                return Job(id, network_name, dataset_name, json.loads(kwargs), group, 0, rung + 1)
+
+        return None
+
+    def record_rung(self, job, score, duration, finished):
+
+        # finished jobs reached their full epoch budget, the others wait for a promotion
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO rung_results (job_id, rung, score) VALUES (?, ?, ?)",
+                (job.id, job.rung, score),
+            )
+            connection.execute(
+                "UPDATE jobs SET status = ?, duration = COALESCE(duration, 0) + ?, error = NULL WHERE id = ?",
+                ("done" if finished else "paused", duration, job.id),
+            )
+
+    def heartbeat(self, worker):
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE status = 'running' AND worker = ?", (time.time(), worker)
+            )
+
+    def complete(self, job, duration=None):
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'done', duration = ?, error = NULL WHERE id = ?", (duration, job.id)
+            )
+
+    def fail(self, job, error, max_attempts=3, backoff=60):
+
+        attempts = job.attempts + 1
+        status = "failed" if attempts >= max_attempts else "pending"
+
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, available_at = ?, worker = NULL, error = ? WHERE id = ?",
+                (status, attempts, time.time() + backoff * 2 ** (attempts - 1), error, job.id),
+            )
+
+        return status
+
+    def expected_costs(self):
+
+        # measured seconds per job group, skipped jobs have no duration
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT job_group, AVG(duration) FROM jobs "
+                "WHERE status = 'done' AND duration IS NOT NULL GROUP BY job_group"
+            ).fetchall()
+
+        return dict(rows)
+
+    def counts(self):
+        with self.transaction() as connection:
+            rows = connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+
+        return dict(rows)
+
+    def errors(self):
+        with self.transaction() as connection:
+            return connection.execute(
+                "SELECT id, network_name, kwargs, attempts, error FROM jobs WHERE status = 'failed'"
+            ).fetchall()
+
+
+class Transaction:
+    def __init__(self, path) -> None:
+        self.path = path
+        self.connection = None
+
+    def __enter__(self):
+
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can not claim the same job
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.execute("BEGIN IMMEDIATE")
+
+        return self.connection
+
+    def __exit__(self, exception_type, exception, traceback):
+
+        if exception_type is None:
+            self.connection.execute("COMMIT")
+        else:
+            self.connection.execute("ROLLBACK")
+
+        self.connection.close()